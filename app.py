@@ -1,35 +1,74 @@
 # Python imports
-import collections
 import datetime
+import json
 import logging
+import math
 import os
+import re
+import signal
+import time
 
 # Tornado imports
 import tornado.auth
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
+import tornado.util
 import tornado.web
 
+from tornado import gen
+from tornado.concurrent import Future
+
 from tornado.options import define, options
 from tornado.web import url
 
 import mongoengine
-import pylibmc
 import yaml
 import pymongo
 
-from pymongo.objectid import ObjectId
+from bson.objectid import ObjectId
 
 # App imports
+import asyncdb
+import bulk
+import cache
 import forms
+import exporter
 import importer
+import metrics
+import prefork
+import schema
+import search
+import snapshots
+import tagcounts
+import tagindex
 import uimodules
+import urls
 import util
+import writebehind
 
 # Options
 define("port", default=8888, type=int)
 define("config_file", default="app_config.yml", help="app_config file")
+define("processes", default=1, type=int,
+       help="number of worker processes to pre-fork, 0 for one per cpu")
+define("max_requests", default=0, type=int,
+       help="recycle a worker after this many requests, 0 for never")
+define("max_worker_age", default=0, type=int,
+       help="recycle a worker after this many seconds, 0 for never")
+define("slow_request_ms", default=0, type=int,
+       help="log requests slower than this many milliseconds, 0 to disable")
+define("shutdown_grace", default=10, type=int,
+       help="seconds a stopping worker waits for in-flight requests")
+
+REQUEST_SECONDS = metrics.histogram('http_request_seconds',
+                                    'Request latency by handler.',
+                                    labels=('handler', 'method'))
+REQUESTS = metrics.counter('http_requests_total', 'Requests by handler and status.',
+                           labels=('handler', 'status'))
+
 
 class Application(tornado.web.Application):
   def __init__(self):
@@ -38,12 +77,23 @@ class Application(tornado.web.Application):
       url(r'/auth/google', GoogleAuthHandler, name='auth_google'),
       url(r'/logout', LogoutHandler, name='logout'),
       url(r'/home', HomeHandler, name='home'),
+      url(r'/home\.json', HomeJSONHandler, name='home_json'),
       url(r'/import', ImportHandler, name='import'),
+      url(r'/export', ExportHandler, name='export'),
+      url(r'/import/status/(?P<job_id>\w+)', ImportStatusHandler,
+          name='import_status'),
       url(r'/edit/(?P<id>\w+)', EditBookmarkHandler, name='edit'),
       url(r'/new', NewBookmarkHandler, name='new'),
       url(r'/b', BookmarkletHandler, name='bookmarklet'),
       url(r'/tags', TagsHandler, name='tags'),
+      url(r'/tags/related', TagHandler, name='tag'),
+      url(r'/tags/complete', TagCompleteHandler, name='tag_complete'),
+      url(r'/search', SearchHandler, name='search'),
+      url(r'/cache/(?P<id>\w+)', CachedTextHandler, name='cache'),
       url(r'/delete_multi', DeleteMultipleBookmarksHandler, name='delete_multi'),
+      url(r'/bookmarks/bulk', BulkBookmarksHandler, name='bulk'),
+      url(r'/stats/cache', CacheStatsHandler, name='cache_stats'),
+      url(r'/metrics', MetricsHandler, name='metrics'),
     ]
     settings = dict(
       debug=self.config.debug,
@@ -55,58 +105,205 @@ class Application(tornado.web.Application):
       ui_modules=uimodules,
     )
     tornado.web.Application.__init__(self, handlers, **settings)
-    self.connection = pymongo.Connection()
-    self.db = self.connection[self.config.mongodb_database]
-    # Create pymongo indexes
-    self.db.users.ensure_index('email')
-    self.db.bookmarks.ensure_index('user')
-    self.db.bookmarks.ensure_index([('user', pymongo.DESCENDING),
-                                    ('url_digest', pymongo.DESCENDING)])
-    self.db.tags.ensure_index('user')
+    self.active_requests = 0
+    self.served_requests = 0
+
+  def __call__(self, request):
+    self.active_requests += 1
+    return tornado.web.Application.__call__(self, request)
+
+  def log_request(self, handler):
+    self.active_requests -= 1
+    self.served_requests += 1
+    elapsed = handler.request.request_time()
+    name = type(handler).__name__
+    REQUEST_SECONDS.observe(elapsed, handler=name, method=handler.request.method)
+    REQUESTS.inc(handler=name, status=handler.get_status())
+    if options.slow_request_ms and elapsed * 1000 >= options.slow_request_ms:
+      logging.warning("Slow request: %s %s (%s) %.0fms" % (
+        handler.request.method, handler.request.uri, name, elapsed * 1000))
+    tornado.web.Application.log_request(self, handler)
+
+  # Connections, clients and the thread pool are created on first use so
+  # that each pre-forked worker gets its own.
+  @property
+  def connection(self):
+    if not hasattr(self, '_connection'):
+      self._connection = pymongo.Connection()
+    return self._connection
+
+  @property
+  def db(self):
+    db = self.connection[self.config.mongodb_database]
+    if self.config.get('instrument_mongo', True):
+      db = metrics.InstrumentedDatabase(db)
+    return schema.wrap(db, self.config)
+
+  @property
+  def adb(self):
+    if not hasattr(self, '_adb'):
+      self._adb = asyncdb.AsyncDatabase(
+        self.db, max_workers=self.config.get('mongo_threads', 10))
+    return self._adb
 
   @property
   def config(self):
     if not hasattr(self, '_config'):
-      logging.debug("Loading app config")
-      stream = file(options.config_file, 'r')
-      self._config = tornado.web._O(yaml.load(stream))
+      self._config = util.load_config(options.config_file)
     return self._config
 
+  @property
+  def snapshots(self):
+    if not hasattr(self, '_snapshots'):
+      # GridFS needs the plain Database.
+      self._snapshots = snapshots.SnapshotStore(
+        self.connection[self.config.mongodb_database])
+    return self._snapshots
+
   @property
   def memcache(self):
     if not hasattr(self, '_memcache'):
-      self._memcache = pylibmc.Client(
-        self.config.memcache_servers,
-        binary=True, behaviors={"tcp_nodelay": True, "ketama": True})
+      self._memcache = cache.memcache_client(self.config.memcache_servers)
     return self._memcache
 
+  @property
+  def tag_indexes(self):
+    if not hasattr(self, '_tag_indexes'):
+      self._tag_indexes = tagindex.TagIndexCache(
+        max_tags=self.config.get('tag_index_max_tags', 500000),
+        ttl=self.config.get('tag_index_ttl', 60))
+      # Keeps indexes current with mutations made by this process.
+      tagcounts.listeners.append(self._tag_indexes.apply)
+      metrics.callback('tag_index_names', 'Tag names held by completion indexes.',
+                       'gauge', lambda: self._tag_indexes.size)
+    return self._tag_indexes
+
+  @property
+  def write_buffer(self):
+    if not hasattr(self, '_write_buffer'):
+      def on_flush(user_ids):
+        for user_id in user_ids:
+          cache.bump_generation(self.memcache, user_id)
+      self._write_buffer = writebehind.WriteBehindBuffer(
+        self.adb, tornado.ioloop.IOLoop.instance(),
+        max_size=self.config.get('writebehind_max_size', 100),
+        max_delay=self.config.get('writebehind_max_delay', 1.0),
+        durability=self.config.get('writebehind_durability', 'journal'),
+        journal_dir=self.config.get('writebehind_journal_dir', 'writebehind'),
+        on_flush=on_flush)
+    return self._write_buffer
+
+  @property
+  def cache(self):
+    if not hasattr(self, '_cache'):
+      self._cache = cache.TieredCache(
+        self.memcache,
+        cache.LRUCache(max_size=self.config.get('cache_local_size', 10000),
+                       ttl=self.config.get('cache_local_ttl', 30)))
+      stats = self._cache.stats
+      metrics.callback('cache_hits_total', 'Cache hits.', 'counter',
+                       lambda: {('local',): stats()['local_hits'],
+                                ('memcache',): stats()['remote_hits']},
+                       labels=('tier',))
+      metrics.callback('cache_misses_total', 'Cache misses.', 'counter',
+                       lambda: {('local',): stats()['local_misses'],
+                                ('memcache',): stats()['remote_misses']},
+                       labels=('tier',))
+      metrics.callback('cache_local_entries', 'Entries in the local cache.',
+                       'gauge', lambda: stats()['local_size'])
+    return self._cache
+
 
 class BaseHandler(tornado.web.RequestHandler):
   @property
   def db(self):
     return self.application.db
 
-  def get_current_user(self):
+  @property
+  def adb(self):
+    return self.application.adb
+
+  @property
+  def cache(self):
+    return self.application.cache
+
+  def page_argument(self):
+    """Returns the 1-based page number asked for, 1 if it is not one."""
+    try:
+      return max(1, int(self.get_argument('page', 1)))
+    except ValueError:
+      return 1
+
+  @gen.coroutine
+  def prepare(self):
     user_id = self.get_secure_cookie('user_id')
-    if not user_id:
-      return None
-    user = self.db.users.find_one({'_id': pymongo.objectid.ObjectId(user_id)})
-    if user is None:
-      return None
-    return tornado.web._O(user)
+    user = None
+    if user_id:
+      user = self.cache.get(cache.user_key(user_id))
+      if user is None:
+        user = yield self.adb.users.find_one({'_id': ObjectId(user_id)})
+        if user is not None:
+          self.cache.set(cache.user_key(user_id), user)
+    self._current_user = tornado.util.ObjectDict(user) if user is not None else None
+
+  @property
+  def user_cache(self):
+    if not hasattr(self, '_user_cache'):
+      self._user_cache = cache.UserCache(self.cache, self.current_user['_id'])
+    return self._user_cache
+
+  def bookmarks_changed(self):
+    """Invalidates the current user's derived caches."""
+    cache.bump_generation(self.application.memcache, self.current_user['_id'])
+    if hasattr(self, '_user_cache'):
+      del self._user_cache
+
+  @gen.coroutine
+  def load_popular_tags(self):
+    """Loads the sidebar tags; call before rendering a page."""
+    tags = self.user_cache.get('tags')
+    if tags is None:
+      tags = yield self.adb.tags.find_list({'user': self.current_user['_id']},
+                                           sort=[('count', pymongo.DESCENDING)],
+                                           limit=20)
+      self.user_cache.set('tags', tags)
+    self.popular_tags = tags
+    raise gen.Return(tags)
+
+  def not_modified(self, names=(), period=None):
+    """
+    Sets an ETag for a page derived from the current user's bookmarks and
+    answers 304 if the client has that version already. The validator is
+    the user's cache generation and, for pages showing fetch statuses,
+    which change without moving the generation, the current `period`
+    seconds window; deciding needs neither Mongo nor a template. `names`
+    are user cache values the page reads, fetched in the same memcache
+    round trip as the generation. Returns whether the 304 was sent.
+    """
+    self.user_cache.get_multi(['tags'] + list(names))
+    parts = [self.current_user['_id'], self.current_user.get('name'),
+             self.user_cache.current_generation(),
+             # Forms embed the xsrf token.
+             self.get_cookie('_xsrf'),
+             self.application.config.get('page_version', 1)]
+    if period:
+      parts.append(int(time.time() // period))
+    etag = '"%s"' % util.md5(u':'.join(unicode(p) for p in parts))
+    self.set_header('Etag', etag)
+    # Pages are per user; browsers must revalidate every time.
+    self.set_header('Cache-Control', 'private, no-cache')
+    client_etags = [t.strip() for t in
+                    self.request.headers.get('If-None-Match', '').split(',')]
+    if etag in client_etags or '*' in client_etags:
+      self.set_status(304)
+      self.finish()
+      return True
+    return False
 
   def render_string(self, template_name, **kwargs):
-    if self.current_user is not None:
-      tags = self.application.memcache.get('%s/tags' % self.current_user['_id'])
-      if tags is None:
-        tags = list(self.db.tags.find({'user': self.current_user['_id']},
-                                      sort=[('count', pymongo.DESCENDING)],
-                                      limit=20))
-        self.application.memcache.set('%s/tags' % self.current_user['_id'], tags)
-    else:
-      tags = []
     return tornado.web.RequestHandler.render_string(
-        self, template_name, popular_tags=tags,
+        self, template_name,
+        popular_tags=[tornado.util.ObjectDict(t) for t in getattr(self, 'popular_tags', [])],
         IS_DEBUG=self.application.config.debug, **kwargs)
 
 
@@ -116,25 +313,27 @@ class IndexHandler(BaseHandler):
 
 
 class GoogleAuthHandler(BaseHandler, tornado.auth.GoogleMixin):
-  @tornado.web.asynchronous
+  @gen.coroutine
   def get(self):
-    if self.get_argument('openid.mode', None):
-      self.get_authenticated_user(self.async_callback(self._on_auth))
+    if not self.get_argument('openid.mode', None):
+      self.authenticate_redirect()
       return
-    self.authenticate_redirect()
-
-  def _on_auth(self, guser):
+    guser = yield self.get_authenticated_user()
     if not guser:
       raise tornado.web.HTTPError(500, "Google auth failed")
 
-    user = self.db.users.find_one({'email': guser['email']})
+    user = yield self.adb.users.find_one({'email': guser['email']})
 
     if user is None:
       user = {
         'email': guser['email'],
         'name': guser['name'],
       }
-      self.db.users.insert(user)
+      yield self.adb.users.insert(user)
+    elif user.get('name') != guser['name']:
+      yield self.adb.users.update({'_id': user['_id']},
+                                  {'$set': {'name': guser['name']}})
+      self.cache.delete(cache.user_key(user['_id']))
     self.set_secure_cookie('user_id', str(user['_id']))
     self.redirect(self.reverse_url('home'))
 
@@ -146,147 +345,629 @@ class LogoutHandler(BaseHandler):
 
 
 class HomeHandler(BaseHandler):
+  PAGE_SIZE = 25
+  # Everything home.html and home.json use but the page status, which is
+  # joined from the urls collection on every request so cached pages need
+  # no invalidation when a page is fetched; modified is needed for the
+  # cursor.
+  FIELDS = ('url', 'title', 'modified', 'canonical_digest')
+
   @tornado.web.authenticated
+  @gen.coroutine
   def get(self):
-    compute_tags(self.db, self.current_user)
+    tag = self.get_argument('tag', None)
+    first_page = tag is None and self.get_argument('cursor', None) is None
+    period = self.application.config.get('page_status_period', 60)
+    names = []
+    html_name = None
+    if first_page:
+      names = ['home', 'count']
+      if period and self.application.config.get('cache_rendered_pages', False):
+        html_name = 'home_html/%d' % (time.time() // period)
+        names.append(html_name)
+    if self.not_modified(names, period):
+      return
+    if html_name is not None:
+      html = self.user_cache.get(html_name)
+      if html is not None:
+        self.finish(html)
+        return
+
+    count = None
+    if first_page:
+      # The first page is served from cache together with everything else
+      # the page needs.
+      page = self.user_cache.get('home')
+      if page is None:
+        page = yield self.get_page()
+        self.user_cache.set('home', page)
+      count = self.user_cache.get('count')
+      if count is None:
+        count = yield self.adb.bookmarks.find_count(
+          {'user': self.current_user['_id']})
+        self.user_cache.set('count', count)
+    else:
+      page = yield self.get_page()
+    bookmarks, next_cursor = page
+    bookmarks = yield self.adb.run(urls.join, self.db, bookmarks)
+    yield self.load_popular_tags()
+    html = self.render_string('home.html',
+                              bookmarks=(tornado.util.ObjectDict(b) for b in bookmarks),
+                              tag=tag,
+                              count=count,
+                              next_cursor=next_cursor)
+    if html_name is not None:
+      self.user_cache.set(html_name, html)
+    self.finish(html)
+
+  @gen.coroutine
+  def get_page(self):
     query = {'user': self.current_user['_id']}
 
     tag = self.get_argument('tag', None)
     if tag is not None:
       query['tags'] = tag
 
-    bookmarks = self.db.bookmarks.find(
+    cursor = self.get_argument('cursor', None)
+    if cursor is not None:
+      try:
+        modified, id = util.decode_cursor(cursor)
+        id = ObjectId(id)
+      except Exception:
+        raise tornado.web.HTTPError(400, "Invalid cursor")
+      query.update(after_position(modified, id))
+
+    bookmarks = yield self.adb.bookmarks.find_list(
         query,
-        sort=[('modified', pymongo.DESCENDING)],
-        skip=int(self.get_argument('offset', 0)),
-        limit=25)
-    self.render('home.html', bookmarks=(tornado.web._O(b) for b in bookmarks))
+        fields=self.FIELDS,
+        sort=[('modified', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+        limit=self.PAGE_SIZE + 1)
+    next_cursor = None
+    if len(bookmarks) > self.PAGE_SIZE:
+      del bookmarks[self.PAGE_SIZE:]
+      last = bookmarks[-1]
+      next_cursor = util.encode_cursor(last.get('modified'), last['_id'])
+    raise gen.Return((bookmarks, next_cursor))
+
+
+class HomeJSONHandler(HomeHandler):
+  @tornado.web.authenticated
+  @gen.coroutine
+  def get(self):
+    bookmarks, next_cursor = yield self.get_page()
+    bookmarks = yield self.adb.run(urls.join, self.db, bookmarks)
+    self.write({
+      'bookmarks': [{
+        'id': str(b['_id']),
+        'url': b['url'],
+        'title': b.get('title'),
+        'status': b.get('status'),
+        'edit_url': self.reverse_url('edit', str(b['_id'])),
+        'cache_url': (self.reverse_url('cache', str(b['_id']))
+                      if b.get('snapshot') else None),
+      } for b in bookmarks],
+      'next': next_cursor,
+    })
 
 
 class ImportHandler(BaseHandler):
   @tornado.web.authenticated
+  @gen.coroutine
   def get(self):
-    self.render('import.html')
+    jobs = yield self.adb.import_jobs.find_list(
+      {'user': self.current_user._id},
+      sort=[('created', pymongo.DESCENDING)],
+      limit=5)
+    yield self.load_popular_tags()
+    self.render('import.html', jobs=(tornado.util.ObjectDict(job) for job in jobs))
 
   @tornado.web.authenticated
+  @gen.coroutine
   def post(self):
     file = self.request.files.get('file')[0]
-    importer.Importer(self.db, self.current_user, file['body']).import_bookmarks()
-    self.redirect(self.reverse_url('home'))
+    yield self.adb.run(
+      importer.enqueue, self.db, self.current_user._id,
+      self.application.config.get('import_spool_dir', 'import_spool'),
+      file['body'])
+    self.redirect(self.reverse_url('import'))
+
+
+class ExportHandler(BaseHandler):
+  """
+  Streams the user's bookmarks as a download. Batches are read and encoded
+  on the Mongo thread pool and each one is flushed to the client before
+  the next is read, so neither memory nor the IOLoop is held up by large
+  libraries.
+  """
+  BOOLEANS = {'': False, '0': False, 'false': False, 'no': False,
+              '1': True, 'true': True, 'yes': True}
+
+  @tornado.web.authenticated
+  @gen.coroutine
+  def get(self):
+    compress = self.BOOLEANS.get(self.get_argument('gzip', '').lower())
+    if compress is None:
+      raise tornado.web.HTTPError(400, "Invalid gzip flag")
+    try:
+      export = exporter.Exporter(self.db, self.current_user._id,
+                                 self.get_argument('format', 'html'),
+                                 compress=compress)
+    except ValueError:
+      raise tornado.web.HTTPError(400, "Unknown format")
+    self.set_header('Content-Type', export.content_type)
+    self.set_header('Content-Disposition',
+                    'attachment; filename="%s"' % export.filename)
+    self.closed = False
+    self.flushed = None
+    chunks = export.chunks()
+    try:
+      while not self.closed:
+        chunk = yield self.adb.run(next, chunks, None)
+        if chunk is None:
+          break
+        self.write(chunk)
+        yield self.flush_or_close()
+    finally:
+      # Closes the cursor if the client went away early.
+      yield self.adb.run(chunks.close)
+    # Also after a disconnect, so the request is logged and counted as done.
+    self.finish()
+
+  def flush_or_close(self):
+    """
+    Flushes the written chunks. The returned Future resolves once they are
+    sent or the client has gone away, whichever is first; the flush
+    callback never runs on a closed connection.
+    """
+    self.flushed = future = Future()
+    self.flush(callback=lambda: future.done() or future.set_result(None))
+    if self.closed and not future.done():
+      future.set_result(None)
+    return future
+
+  def on_connection_close(self):
+    self.closed = True
+    if self.flushed is not None and not self.flushed.done():
+      self.flushed.set_result(None)
+
+
+class ImportStatusHandler(BaseHandler):
+  @tornado.web.authenticated
+  @gen.coroutine
+  def get(self, job_id):
+    if not ObjectId.is_valid(job_id):
+      raise tornado.web.HTTPError(404)
+    job = yield self.adb.import_jobs.find_one(
+      dict(user=self.current_user._id, _id=ObjectId(job_id)))
+    if job is None:
+      raise tornado.web.HTTPError(404)
+    status = dict(job['stats'], id=str(job['_id']), state=job['state'])
+    self.write(status)
 
 
 class EditBookmarkHandler(BaseHandler):
   @tornado.web.authenticated
+  @gen.coroutine
   def get(self, id):
-    bookmark = self.db.bookmarks.find_one(
+    if self.not_modified():
+      return
+    bookmark = yield self.adb.bookmarks.find_one(
       dict(user=ObjectId(self.current_user._id), _id=ObjectId(id)))
     if bookmark is None:
       raise tornado.web.HTTPError(404)
-    form = forms.BookmarkForm(obj=tornado.web._O(bookmark))
+    form = forms.BookmarkForm(obj=tornado.util.ObjectDict(bookmark))
+    yield self.load_popular_tags()
     self.render('edit.html', form=form)
 
   @tornado.web.authenticated
+  @gen.coroutine
   def post(self, id):
-    bookmark = self.db.bookmarks.find_one(
+    bookmark = yield self.adb.bookmarks.find_one(
       dict(user=ObjectId(self.current_user._id), _id=ObjectId(id)))
     if bookmark is None:
       raise tornado.web.HTTPError(404)
-    bookmark = tornado.web._O(bookmark)
+    bookmark = tornado.util.ObjectDict(bookmark)
+    old = dict(bookmark)
     form = forms.BookmarkForm(self, obj=bookmark)
-    if form.validate():
+    valid = form.validate()
+    if valid:
+      canonical_digest = util.canonical_digest(form.url.data)
+      duplicate = yield self.adb.bookmarks.find_one(
+        {'user': bookmark.user, 'canonical_digest': canonical_digest,
+         '_id': {'$ne': bookmark._id}}, fields=['_id'])
+      if duplicate is not None:
+        form.url.errors.append("You already have a bookmark for this url.")
+        valid = False
+    if valid:
       form.populate_obj(bookmark)
-      self.db.bookmarks.save(bookmark)
+      bookmark.url_digest = util.md5(bookmark.url)
+      moved = bookmark.get('canonical_digest') != canonical_digest
+      if moved:
+        # The text was fetched for the old url.
+        bookmark.pop('text', None)
+        bookmark.canonical_digest = canonical_digest
+      try:
+        yield self.adb.run(save_bookmark, self.db, bookmark, old)
+      except pymongo.errors.DuplicateKeyError:
+        # Another request saved the url since the check above.
+        form.url.errors.append("You already have a bookmark for this url.")
+        valid = False
+    if valid:
+      if moved:
+        yield self.adb.run(bulk.track_urls, self.db, bookmark.user, [bookmark])
+      self.bookmarks_changed()
       self.redirect(self.reverse_url('home'))
     else:
+      yield self.load_popular_tags()
       self.render('edit.html', form=form)
 
 
 class NewBookmarkHandler(BaseHandler):
   @tornado.web.authenticated
+  @gen.coroutine
   def get(self):
     form = forms.BookmarkForm()
+    yield self.load_popular_tags()
     self.render('new.html', form=form)
 
   @tornado.web.authenticated
+  @gen.coroutine
   def post(self):
     form = forms.BookmarkForm(self)
     if form.validate():
-      bookmark = self.db.bookmarks.find_one({
-        'user': self.current_user._id, 'url': form.url.data})
-      if bookmark is None:
-        bookmark = dict(user=self.current_user._id,
-                        modified=datetime.datetime.now())
-      bookmark = tornado.web._O(bookmark)
+      bookmark = tornado.util.ObjectDict(user=self.current_user._id,
+                                         modified=datetime.datetime.now())
       form.populate_obj(bookmark)
-      self.db.bookmarks.insert(bookmark)
+      bookmark.url_digest = util.md5(bookmark.url)
+      yield self.adb.run(bulk.upsert_bookmarks,
+                         self.db, self.current_user._id, [bookmark])
+      self.bookmarks_changed()
       self.redirect(self.reverse_url('home'))
     else:
+      yield self.load_popular_tags()
       self.render('new.html', form=form)
 
 
 class BookmarkletHandler(BaseHandler):
   @tornado.web.authenticated
+  @gen.coroutine
   def get(self):
     form = forms.BookmarkletForm(self)
     if form.validate():
-      if not form.title.data:
-        form.title.data = form.url.data
-      url_digest = util.md5(form.url.data)
-      bookmark = self.db.bookmarks.find_one({
-          'user': self.current_user._id,
-          'url_digest': url_digest})
-      if bookmark is None:
-        bookmark = {'user': self.current_user._id,
-                    'modified': datetime.datetime.now()}
-      bookmark = tornado.web._O(bookmark)
-      form.populate_obj(bookmark)
-      self.db.bookmarks.save(bookmark)
+      # Saves go through the write-behind buffer: nothing is read back here,
+      # the flush does the upsert, tag counts and retrieval task.
+      bookmark = {'user': self.current_user._id,
+                  'url': form.url.data,
+                  'url_digest': util.md5(form.url.data),
+                  'title': form.title.data or form.url.data,
+                  'modified': datetime.datetime.now()}
+      for name in ('description', 'tags'):
+        if name in self.request.arguments:
+          bookmark[name] = getattr(form, name).data
+      yield self.application.write_buffer.add(bookmark)
       self.write('oldu')
     else:
       self.write('%s' % form.errors)
 
 
+class CachedTextHandler(BaseHandler):
+  @tornado.web.authenticated
+  @gen.coroutine
+  def get(self, id):
+    bookmark = yield self.adb.bookmarks.find_one(
+      dict(user=self.current_user._id, _id=ObjectId(id)),
+      fields=['url', 'title', 'canonical_digest'])
+    if bookmark is None:
+      raise tornado.web.HTTPError(404)
+    bookmark = (yield self.adb.run(urls.join, self.db, [bookmark]))[0]
+    if not bookmark.get('snapshot'):
+      raise tornado.web.HTTPError(404)
+    text = yield self.adb.run(self.application.snapshots.text,
+                              bookmark['snapshot'])
+    yield self.load_popular_tags()
+    self.render('cache.html', bookmark=tornado.util.ObjectDict(bookmark), text=text)
+
+
+class SearchHandler(BaseHandler):
+  PAGE_SIZE = 25
+
+  @tornado.web.authenticated
+  @gen.coroutine
+  def get(self):
+    query = self.get_argument('q', u'')
+    page = min(self.page_argument(), 40)
+    bookmarks = yield self.adb.run(search.search, self.db,
+                                   self.current_user._id, query,
+                                   limit=self.PAGE_SIZE + 1,
+                                   skip=(page - 1) * self.PAGE_SIZE)
+    has_next = len(bookmarks) > self.PAGE_SIZE
+    bookmarks = yield self.adb.run(urls.join, self.db, bookmarks[:self.PAGE_SIZE])
+    yield self.load_popular_tags()
+    self.render('search.html', query=query, page=page, has_next=has_next,
+                bookmarks=[tornado.util.ObjectDict(b) for b in bookmarks])
+
+
 class TagsHandler(BaseHandler):
+  """All tags as a cloud, by count or by name, optionally filtered by
+  prefix. Reads only the per-user tag counters."""
+  PAGE_SIZE = 100
+  SORTS = {
+    'count': [('count', pymongo.DESCENDING), ('name', pymongo.ASCENDING)],
+    'name': [('name', pymongo.ASCENDING)],
+  }
+
+  @tornado.web.authenticated
+  @gen.coroutine
+  def get(self):
+    sort = self.get_argument('sort', 'count')
+    if sort not in self.SORTS:
+      raise tornado.web.HTTPError(400, "Unknown sort")
+    if self.not_modified():
+      return
+    prefix = self.get_argument('prefix', u'').strip().lower()
+    page = self.page_argument()
+    query = {'user': self.current_user._id}
+    if prefix:
+      query['name'] = {'$regex': '^' + re.escape(prefix)}
+    tags = yield self.adb.tags.find_list(query, fields=['name', 'count'],
+                                         sort=self.SORTS[sort],
+                                         skip=(page - 1) * self.PAGE_SIZE,
+                                         limit=self.PAGE_SIZE + 1)
+    has_next = len(tags) > self.PAGE_SIZE
+    tags = [tornado.util.ObjectDict(tag) for tag in tags[:self.PAGE_SIZE]]
+    yield self.load_popular_tags()
+    self.render('tags.html', tags=tags, sizes=cloud_sizes(tags), sort=sort,
+                prefix=prefix, page=page, has_next=has_next)
+
+
+class TagCompleteHandler(BaseHandler):
+  """Completes the last tag of a comma separated list, most used first."""
+  LIMIT = 10
+
   @tornado.web.authenticated
+  @gen.coroutine
   def get(self):
-    tags = self.db.tags.find({'user': self.current_user._id},
-                            sort=[('count', pymongo.DESCENDING)],
-                            limit=20)
-    self.render('tags.html', tags=(tornado.web._O(tag) for tag in tags))
+    prefix = self.get_argument('q', u'').split(',')[-1].strip().lower()
+    user_id = self.current_user._id
+    index = self.application.tag_indexes.get(user_id)
+    if index is None:
+      tags = yield self.adb.tags.find_list({'user': user_id},
+                                           fields=['name', 'count'])
+      index = self.application.tag_indexes.put(user_id, tagindex.TagIndex(tags))
+    self.write({'tags': [{'name': name, 'count': count}
+                         for name, count in index.complete(prefix, self.LIMIT)]})
+
+
+class TagHandler(BaseHandler):
+  RELATED = 30
+
+  @tornado.web.authenticated
+  @gen.coroutine
+  def get(self):
+    name = self.get_argument('name').strip().lower()
+    # Memcache keys cannot hold arbitrary tag names.
+    key = 'related/%s' % util.md5(name)
+    if self.not_modified([key]):
+      return
+    related = self.user_cache.get(key)
+    if related is None:
+      related = yield self.adb.run(tagcounts.related, self.db,
+                                   self.current_user._id, name, self.RELATED)
+      self.user_cache.set(key, related)
+    tag = yield self.adb.tags.find_one({'user': self.current_user._id,
+                                        'name': name}, fields=['name', 'count'])
+    if tag is None:
+      raise tornado.web.HTTPError(404)
+    related = [tornado.util.ObjectDict(t) for t in related]
+    yield self.load_popular_tags()
+    self.render('tag.html', tag=tornado.util.ObjectDict(tag), related=related,
+                sizes=cloud_sizes(related))
 
 
 class DeleteMultipleBookmarksHandler(BaseHandler):
   @tornado.web.authenticated
+  @gen.coroutine
   def post(self):
     ids = [ObjectId(id) for id in self.get_arguments('ids[]')]
-    bookmarks = self.db.bookmarks.remove({
-      'user': self.current_user._id, '_id': {'$in': ids}})
+    yield self.adb.run(bulk.delete_bookmarks, self.db, self.current_user._id, ids)
+    self.bookmarks_changed()
     self.finish()
 
 
-def compute_tags(db, user):
-  count = collections.defaultdict(int)
-  tags = []
-  for bookmark in db.bookmarks.find({'user': user._id}, fields=['tags']):
-    if 'tags' not in bookmark:
-      continue
-    for tag in bookmark['tags']:
-      count[tag] += 1
-  for tag, count in count.items():
-    tags.append({
-      "user" : user._id,
-      'name': tag,
-      'count': count,
-    })
-  db.tags.remove({'user': user._id})
-  if tags:
-    db.tags.insert(tags)
+class BulkBookmarksHandler(BaseHandler):
+  """
+  Applies one operation to many bookmarks as a single multi update. Takes a
+  JSON body:
+
+    {"op": "add_tags", "ids": [...], "tags": [...]}
+    {"op": "remove_tags", "ids": [...], "tags": [...]}
+    {"op": "rename_tag", "from": "old", "to": "new"}
+    {"op": "delete", "ids": [...]}
+
+  and answers with the number of bookmarks matched.
+  """
+  MAX_IDS = 10000
+
+  @tornado.web.authenticated
+  @gen.coroutine
+  def post(self):
+    try:
+      request = json.loads(self.request.body)
+      op = request['op']
+    except (ValueError, KeyError, TypeError):
+      raise tornado.web.HTTPError(400, "Invalid request")
+    user_id = self.current_user._id
+
+    if op == 'rename_tag':
+      old_name = forms.clean_tags([unicode(request.get('from') or u'')])
+      new_name = forms.clean_tags([unicode(request.get('to') or u'')])
+      if not old_name or not new_name:
+        raise tornado.web.HTTPError(400, "rename_tag needs from and to")
+      matched = yield self.adb.run(bulk.rename_tag, self.db, user_id,
+                                   old_name[0], new_name[0])
+    elif op in ('add_tags', 'remove_tags', 'delete'):
+      try:
+        ids = [ObjectId(id) for id in request.get('ids') or ()]
+      except Exception:
+        raise tornado.web.HTTPError(400, "Invalid id")
+      if not ids or len(ids) > self.MAX_IDS:
+        raise tornado.web.HTTPError(400, "Between 1 and %d ids" % self.MAX_IDS)
+      if op == 'delete':
+        matched = yield self.adb.run(bulk.delete_bookmarks, self.db, user_id, ids)
+      else:
+        tags = request.get('tags') or ()
+        if isinstance(tags, basestring):
+          tags = tags.split(',')
+        if not all(isinstance(t, basestring) for t in tags):
+          raise tornado.web.HTTPError(400, "Invalid tags")
+        tags = forms.clean_tags(tags)
+        if not tags:
+          raise tornado.web.HTTPError(400, "%s needs tags" % op)
+        operation = bulk.add_tags if op == 'add_tags' else bulk.remove_tags
+        matched = yield self.adb.run(operation, self.db, user_id, ids, tags)
+    else:
+      raise tornado.web.HTTPError(400, "Unknown operation")
+
+    if matched:
+      self.bookmarks_changed()
+    self.write({'op': op, 'matched': matched})
+
+
+class CacheStatsHandler(BaseHandler):
+  @tornado.web.authenticated
+  def get(self):
+    self.write(self.cache.stats())
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+  def get(self):
+    self.set_header('Content-Type', metrics.CONTENT_TYPE)
+    self.write(metrics.REGISTRY.render())
+
+
+def cloud_sizes(tags, steps=5):
+  """Maps tag names to a size from 1 to `steps`, on a log scale of counts."""
+  if not tags:
+    return {}
+  weights = dict((t['name'], math.log(max(t['count'], 1))) for t in tags)
+  low, high = min(weights.values()), max(weights.values())
+  spread = (high - low) or 1
+  return dict((name, 1 + int(round((weight - low) / spread * (steps - 1))))
+              for name, weight in weights.iteritems())
+
+def save_bookmark(db, bookmark, old):
+  db.bookmarks.save(bookmark)
+  tagcounts.update(db, bookmark['user'], old.get('tags'), bookmark.get('tags'))
+  search.change_terms(db, bookmark['user'], removed=[old], added=[bookmark])
+
+def after_position(modified, id):
+  """
+  Returns the query clause selecting bookmarks that sort after (modified, id)
+  in (modified DESC, _id DESC) order. Missing dates sort last.
+  """
+  if modified is None:
+    return {'modified': None, '_id': {'$lt': id}}
+  return {'$or': [
+    {'modified': {'$lt': modified}},
+    {'modified': modified, '_id': {'$lt': id}},
+    {'modified': None},
+  ]}
+
+def serve(sockets):
+  """
+  Runs one server process on already bound sockets. On SIGTERM, or once
+  the worker has served --max_requests requests or lived --max_worker_age
+  seconds, it stops accepting connections and exits when in-flight
+  requests and buffered bookmarklet saves are done or --shutdown_grace has
+  passed.
+  """
+  application = Application()
+  metrics.callback('http_requests_active', 'Requests in progress.', 'gauge',
+                   lambda: application.active_requests)
+  # Created up front so journals of crashed workers are replayed at start.
+  application.write_buffer
+  http_server = tornado.httpserver.HTTPServer(application)
+  http_server.add_sockets(sockets)
+  io_loop = tornado.ioloop.IOLoop.instance()
+  started = time.time()
+  state = {'stopping': None}
+
+  def stop():
+    if state['stopping'] is None:
+      logging.info("Worker %d stopping" % os.getpid())
+      http_server.stop()
+      application.write_buffer.flush()
+      state['stopping'] = time.time()
+
+  def check():
+    if state['stopping'] is None:
+      if ((options.max_requests and
+           application.served_requests >= options.max_requests) or
+          (options.max_worker_age and
+           time.time() - started >= options.max_worker_age)):
+        stop()
+    elif ((not application.active_requests and not application.write_buffer) or
+          time.time() - state['stopping'] > options.shutdown_grace):
+      io_loop.stop()
+
+  signal.signal(signal.SIGTERM,
+                lambda signum, frame: io_loop.add_callback_from_signal(stop))
+  tornado.ioloop.PeriodicCallback(check, 100, io_loop=io_loop).start()
+  io_loop.start()
+
+def ensure_indexes(db):
+  db.users.ensure_index('email')
+  db.bookmarks.ensure_index('user')
+  db.bookmarks.ensure_index([('user', pymongo.DESCENDING),
+                             ('url_digest', pymongo.DESCENDING)])
+  # Backs the upserts of bulk.upsert_bookmarks. It can only be made
+  # unique once dedupe.py has merged the bookmarks saved before canonical
+  # digests existed, so that is left to dedupe.py.
+  if not bulk.has_unique_key_index(db):
+    logging.warning("The (user, canonical_digest) index on bookmarks is not "
+                    "unique; run dedupe.py")
+    db.bookmarks.ensure_index(bulk.BOOKMARK_KEY)
+  # The retriever updates the page text of all bookmarks of a url.
+  db.bookmarks.ensure_index('canonical_digest')
+  db.bookmarks.ensure_index([('user', pymongo.ASCENDING),
+                             ('modified', pymongo.DESCENDING),
+                             ('_id', pymongo.DESCENDING)])
+  db.bookmarks.ensure_index([('user', pymongo.ASCENDING),
+                             ('tags', pymongo.ASCENDING),
+                             ('modified', pymongo.DESCENDING),
+                             ('_id', pymongo.DESCENDING)])
+  search.ensure_indexes(db)
+  db.import_jobs.ensure_index([('state', pymongo.ASCENDING),
+                               ('created', pymongo.ASCENDING)])
+  db.import_jobs.ensure_index([('user', pymongo.ASCENDING),
+                               ('created', pymongo.DESCENDING)])
+  db.tags.ensure_index('user')
+  db.tags.ensure_index([('user', pymongo.ASCENDING),
+                        ('name', pymongo.ASCENDING)], unique=True)
+  db.tags.ensure_index([('user', pymongo.ASCENDING),
+                        ('count', pymongo.DESCENDING)])
+  tagcounts.ensure_indexes(db)
+  urls.ensure_indexes(db)
+  db.tasks.ensure_index('canonical')
 
 def main():
   tornado.options.parse_command_line()
-  http_server = tornado.httpserver.HTTPServer(Application())
-  http_server.listen(options.port)
-  tornado.ioloop.IOLoop.instance().start()
+  config = util.load_config(options.config_file)
+  if config.get('debug') and options.processes != 1:
+    # Autoreload starts an IOLoop, which forked workers would share.
+    raise SystemExit("debug needs --processes=1")
+  sockets = tornado.netutil.bind_sockets(options.port)
+  # Index creation runs once, before forking, on a plain connection that is
+  # closed again so nothing is shared with the workers.
+  connection = pymongo.Connection()
+  ensure_indexes(schema.wrap(connection[config.mongodb_database], config))
+  connection.disconnect()
+
+  if options.processes == 1:
+    serve(sockets)
+  else:
+    processes = options.processes or tornado.process.cpu_count()
+    prefork.Supervisor(processes, serve, sockets).run()
 
 if __name__ == '__main__':
   main()
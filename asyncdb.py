@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabase(object):
+  """
+  Runs blocking pymongo calls on a bounded thread pool so they do not stall
+  the IOLoop. Every call returns a Future that coroutines can yield:
+
+    bookmark = yield self.adb.bookmarks.find_one({'_id': id})
+    bookmarks = yield self.adb.bookmarks.find_list(query, limit=25)
+    result = yield self.adb.run(some_function, db, ...)
+
+  pymongo connections are thread safe; memcache clients are not, so keep
+  cache access on the IOLoop thread.
+  """
+  def __init__(self, db, max_workers=10):
+    self.db = db
+    self.executor = ThreadPoolExecutor(max_workers)
+
+  def run(self, fn, *args, **kwargs):
+    return self.executor.submit(fn, *args, **kwargs)
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    return AsyncCollection(self, self.db[name])
+
+  def __getitem__(self, name):
+    return AsyncCollection(self, self.db[name])
+
+
+class AsyncCollection(object):
+  def __init__(self, adb, collection):
+    self.adb = adb
+    self.collection = collection
+
+  def __getattr__(self, name):
+    method = getattr(self.collection, name)
+    def call(*args, **kwargs):
+      return self.adb.run(method, *args, **kwargs)
+    return call
+
+  def find_list(self, *args, **kwargs):
+    """Runs a find and reads the whole cursor in the pool."""
+    return self.adb.run(lambda: list(self.collection.find(*args, **kwargs)))
+
+  def find_count(self, *args, **kwargs):
+    return self.adb.run(lambda: self.collection.find(*args, **kwargs).count())
@@ -0,0 +1,121 @@
+"""
+Load test for blocking versus executor-backed Mongo access in handlers.
+
+Runs two variants of the same handler in a server subprocess: one calls the
+collection directly on the IOLoop thread, the other yields the call through
+asyncdb.AsyncDatabase. The collection is an in-process stand-in whose
+queries sleep, so no mongod is needed. A mix of slow and fast requests is
+sent concurrently and latency percentiles of the fast requests are
+reported for each variant.
+
+  python benchmarks/bench_async_mongo.py --requests=2000 --slow_ratio=0.1
+"""
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.options
+import tornado.web
+from tornado import gen
+from tornado.options import define, options
+
+import asyncdb
+
+define("requests", default=2000, type=int)
+define("concurrency", default=50, type=int)
+define("slow_ratio", default=0.1, type=float,
+       help="share of requests that run a slow query")
+define("slow_ms", default=200, type=int)
+define("fast_ms", default=1, type=int)
+define("threads", default=10, type=int, help="executor threads")
+define("bench_port", default=8891, type=int)
+
+
+class FakeCollection(object):
+  def find_one(self, spec):
+    time.sleep((options.slow_ms if spec.get('slow') else options.fast_ms) / 1000.0)
+    return {'_id': 1}
+
+
+class FakeDatabase(object):
+  def __getitem__(self, name):
+    return FakeCollection()
+
+  def __getattr__(self, name):
+    return FakeCollection()
+
+
+class BlockingHandler(tornado.web.RequestHandler):
+  def get(self):
+    self.application.db.bookmarks.find_one({'slow': bool(self.get_argument('slow', ''))})
+    self.write('ok')
+
+
+class AsyncHandler(tornado.web.RequestHandler):
+  @gen.coroutine
+  def get(self):
+    yield self.application.adb.bookmarks.find_one(
+      {'slow': bool(self.get_argument('slow', ''))})
+    self.write('ok')
+
+
+def serve():
+  app = tornado.web.Application([
+    (r'/blocking', BlockingHandler),
+    (r'/async', AsyncHandler),
+  ])
+  app.db = FakeDatabase()
+  app.adb = asyncdb.AsyncDatabase(app.db, max_workers=options.threads)
+  tornado.httpserver.HTTPServer(app).listen(options.bench_port)
+  tornado.ioloop.IOLoop.instance().start()
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+@gen.coroutine
+def load(path):
+  client = tornado.httpclient.AsyncHTTPClient(max_clients=options.concurrency)
+  latencies = []
+
+  @gen.coroutine
+  def worker(n):
+    for i in range(n):
+      slow = random.random() < options.slow_ratio
+      url = 'http://127.0.0.1:%d%s%s' % (options.bench_port, path,
+                                         '?slow=1' if slow else '')
+      started = time.time()
+      yield client.fetch(url)
+      if not slow:
+        latencies.append((time.time() - started) * 1000)
+
+  per_worker = options.requests // options.concurrency
+  yield [worker(per_worker) for i in range(options.concurrency)]
+  raise gen.Return(latencies)
+
+
+def main():
+  tornado.options.parse_command_line()
+  server = multiprocessing.Process(target=serve)
+  server.daemon = True
+  server.start()
+  time.sleep(0.5)
+
+  io_loop = tornado.ioloop.IOLoop.instance()
+  for path in ('/blocking', '/async'):
+    latencies = io_loop.run_sync(lambda: load(path))
+    print '%-10s fast requests: p50 %7.1fms  p99 %7.1fms' % (
+      path, percentile(latencies, 0.5), percentile(latencies, 0.99))
+  server.terminate()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,98 @@
+"""
+Measures Retriever throughput against a local stub HTTP server.
+
+Needs a local mongod; tasks are written to a scratch database which is
+dropped afterwards.
+
+  python benchmarks/bench_retriever.py --tasks=2000 --hosts=20 --delay=0.05
+"""
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pymongo
+import tornado.httpserver
+import tornado.ioloop
+import tornado.options
+import tornado.web
+from tornado.options import define, options
+
+import retriever
+import util
+
+define("tasks", default=2000, type=int, help="number of urls to fetch")
+define("hosts", default=20, type=int,
+       help="number of distinct host names, all pointing at the stub server")
+define("delay", default=0.05, type=float, help="stub server response delay")
+define("stub_port", default=8890, type=int)
+define("database", default="bookmarks_benchmark")
+
+
+class StubHandler(tornado.web.RequestHandler):
+  @tornado.web.asynchronous
+  def get(self, path):
+    tornado.ioloop.IOLoop.instance().add_timeout(
+      time.time() + options.delay, self.reply)
+
+  def reply(self):
+    self.finish('<html><title>stub</title><body>stub page</body></html>')
+
+
+def serve_stub():
+  app = tornado.web.Application([(r'/(.*)', StubHandler)])
+  tornado.httpserver.HTTPServer(app).listen(options.stub_port)
+  tornado.ioloop.IOLoop.instance().start()
+
+
+def measure(db):
+  """Runs the retriever over --tasks queued urls in `db` and returns its
+  throughput."""
+  stub = multiprocessing.Process(target=serve_stub)
+  stub.daemon = True
+  stub.start()
+
+  db.tasks.remove()
+  db.urls.remove()
+  tasks = []
+  for i in range(options.tasks):
+    # 127.x.y.z all resolve to the loopback interface, so each counts as a
+    # separate host for the politeness limits.
+    host = '127.0.%d.%d' % (i % options.hosts // 250, i % options.hosts % 250 + 1)
+    url = u'http://%s:%d/page/%d' % (host, options.stub_port, i)
+    tasks.append({'url': url, 'canonical': util.canonical_digest(url), 'status': False})
+  db.tasks.insert(tasks)
+
+  r = retriever.Retriever(db=db)
+  started = time.time()
+  result = {}
+
+  def check():
+    if db.tasks.count() == 0:
+      elapsed = time.time() - started
+      result.update(tasks=options.tasks, hosts=options.hosts,
+                    delay=options.delay, seconds=elapsed,
+                    urls_per_second=options.tasks / elapsed)
+      r.io_loop.stop()
+    else:
+      r.io_loop.add_timeout(time.time() + 0.1, check)
+
+  r.io_loop.add_callback(check)
+  r.run()
+  stub.terminate()
+  return result
+
+
+def main():
+  tornado.options.parse_command_line()
+  db = pymongo.Connection()[options.database]
+  result = measure(db)
+  print '%d urls in %.2fs: %.1f urls/s' % (result['tasks'], result['seconds'],
+                                           result['urls_per_second'])
+  pymongo.Connection().drop_database(options.database)
+
+if __name__ == '__main__':
+  main()
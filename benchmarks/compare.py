@@ -0,0 +1,38 @@
+"""
+Compares two result files written by benchmarks/run.py.
+
+  python benchmarks/compare.py before.json after.json
+"""
+import json
+import sys
+
+
+def flatten(value, prefix=''):
+  if isinstance(value, dict):
+    for key in sorted(value):
+      for item in flatten(value[key], prefix + '.' + key if prefix else key):
+        yield item
+  elif isinstance(value, (int, float)) and not isinstance(value, bool):
+    yield prefix, value
+
+
+def main():
+  if len(sys.argv) != 3:
+    sys.exit(__doc__)
+  with open(sys.argv[1]) as f:
+    before = json.load(f)
+  with open(sys.argv[2]) as f:
+    after = json.load(f)
+  print 'before: %s\nafter:  %s\n' % (before.get('commit'), after.get('commit'))
+  old = dict(flatten(before['results']))
+  for key, value in flatten(after['results']):
+    if key not in old:
+      print '%-60s %12s %12.2f' % (key, '-', value)
+    elif old[key]:
+      print '%-60s %12.2f %12.2f %+8.1f%%' % (
+        key, old[key], value, (value - old[key]) * 100.0 / old[key])
+    else:
+      print '%-60s %12.2f %12.2f' % (key, old[key], value)
+
+if __name__ == '__main__':
+  main()
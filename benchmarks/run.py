@@ -0,0 +1,408 @@
+"""
+Benchmark suite for the hot paths. Writes its results as JSON so runs on
+different commits can be compared with benchmarks/compare.py.
+
+Needs a local mongod, and memcached for the web server benchmarks. All data
+is written to a scratch database which is dropped afterwards.
+
+  python benchmarks/run.py
+  python benchmarks/run.py --benchmarks=importer,tags --import_sizes=10000
+  python benchmarks/compare.py before.json after.json
+
+Benchmarks:
+  importer     Importer.import_bookmarks on synthetic Netscape files
+  tags         tag count maintenance: full recount, incremental updates and
+               the sidebar query, at several bookmark and tag cardinalities
+  home         /home rendering at increasing cursor depths
+  bookmarklet  /b save throughput, and time until the saves are flushed
+  retriever    Retriever throughput against a local stub server
+"""
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import pymongo
+import tornado.httpclient
+import tornado.ioloop
+import tornado.options
+import tornado.util
+import tornado.web
+import yaml
+from bson.objectid import ObjectId
+from tornado import gen
+from tornado.options import define, options
+
+import bench_retriever
+import importer
+import tagcounts
+import util
+
+define("benchmarks", default="importer,tags,home,bookmarklet,retriever",
+       help="comma separated benchmarks to run")
+define("output", default=None,
+       help="result file, defaults to benchmarks/results/<time>-<commit>.json")
+define("import_sizes", default="10000,100000,1000000",
+       help="links per synthetic import file")
+define("tag_bookmarks", default="1000,10000,100000",
+       help="bookmark counts for the tags benchmark")
+define("tag_cardinalities", default="10,100,1000",
+       help="distinct tag counts for the tags benchmark")
+define("home_bookmarks", default=100000, type=int)
+define("home_depths", default="0,10,100,1000,3999",
+       help="pages skipped before the measured /home page")
+define("home_requests", default=50, type=int, help="requests per depth")
+define("bookmarklet_saves", default=5000, type=int)
+define("bookmarklet_concurrency", default=50, type=int)
+define("writebehind_durability", default="journal")
+define("app_port", default=8892, type=int)
+define("memcache_server", default="127.0.0.1")
+
+COOKIE_SECRET = 'benchmark'
+PAGE_SIZE = 25
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def latency_summary(latencies):
+  return {
+    'requests': len(latencies),
+    'mean_ms': sum(latencies) / len(latencies),
+    'p50_ms': percentile(latencies, 0.5),
+    'p99_ms': percentile(latencies, 0.99),
+  }
+
+
+def max_rss_kb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def int_list(value):
+  return [int(x) for x in value.split(',') if x]
+
+
+def clear(db):
+  for name in ('bookmarks', 'tags', 'tasks', 'search_terms', 'urls'):
+    db[name].remove()
+
+
+def make_user(db):
+  user_id = db.users.insert({'email': 'benchmark@example.com', 'name': 'Benchmark'})
+  return tornado.util.ObjectDict(db.users.find_one({'_id': user_id}))
+
+
+def random_tags(tags, n=3):
+  return sorted(set(random.choice(tags) for i in range(n)))
+
+
+def seed_bookmarks(db, user_id, count, tags):
+  """Inserts `count` bookmarks with 3 random tags each, newest first, with
+  the fields bulk.upsert_bookmarks writes."""
+  now = datetime.datetime.now()
+  batch = []
+  for i in range(count):
+    url = u'http://host%d.example.com/page/%d' % (i % 500, i)
+    batch.append({
+      'user': user_id,
+      'url': url,
+      'url_digest': util.md5(url),
+      'canonical_digest': util.canonical_digest(url),
+      'title': u'Bookmark %d' % i,
+      'tags': random_tags(tags),
+      'modified': now - datetime.timedelta(seconds=i),
+    })
+    if len(batch) == 1000:
+      db.bookmarks.insert(batch)
+      batch = []
+  if batch:
+    db.bookmarks.insert(batch)
+  tagcounts.reconcile(db, user_id)
+
+
+def write_netscape_file(f, links):
+  f.write('<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+          '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+          '<TITLE>Bookmarks</TITLE>\n<H1>Bookmarks</H1>\n<DL><p>\n')
+  tags = ['tag%d' % i for i in range(200)]
+  for i in range(links):
+    if i % 1000 == 0:
+      if i:
+        f.write('</DL><p>\n')
+      f.write('<DT><H3>Folder %d</H3>\n<DL><p>\n' % (i // 1000))
+    f.write('<DT><A HREF="http://host%d.example.com/page/%d" ADD_DATE="%d" '
+            'TAGS="%s">Page %d</A>\n' % (i % 500, i, 1300000000 + i,
+                                         ','.join(random_tags(tags)), i))
+    if i % 3 == 0:
+      f.write('<DD>Description of page %d\n' % i)
+  if links:
+    f.write('</DL><p>\n')
+  f.write('</DL><p>\n')
+
+
+def bench_importer(db):
+  results = {}
+  for size in int_list(options.import_sizes):
+    clear(db)
+    owner = make_user(db)
+    with tempfile.TemporaryFile() as f:
+      write_netscape_file(f, size)
+      f.seek(0)
+      started = time.time()
+      stats = importer.Importer(db, owner, f).import_bookmarks()
+      elapsed = time.time() - started
+    results[str(size)] = {
+      'seconds': elapsed,
+      'links_per_second': size / elapsed,
+      'inserted': stats['inserted'],
+      'max_rss_kb': max_rss_kb(),
+    }
+    print 'importer %8d links: %7.2fs %8.0f links/s' % (size, elapsed, size / elapsed)
+  return results
+
+
+def bench_tags(db):
+  results = {}
+  for count in int_list(options.tag_bookmarks):
+    for cardinality in int_list(options.tag_cardinalities):
+      clear(db)
+      user_id = make_user(db)._id
+      tags = [u'tag%d' % i for i in range(cardinality)]
+      seed_bookmarks(db, user_id, count, tags)
+
+      started = time.time()
+      tagcounts.reconcile(db, user_id)
+      recount = time.time() - started
+
+      updates = 1000
+      started = time.time()
+      for i in range(updates):
+        tagcounts.update(db, user_id, random_tags(tags), random_tags(tags))
+      incremental = (time.time() - started) / updates
+
+      queries = 100
+      started = time.time()
+      for i in range(queries):
+        list(db.tags.find({'user': user_id},
+                          sort=[('count', pymongo.DESCENDING)], limit=20))
+      sidebar = (time.time() - started) / queries
+
+      key = '%d_bookmarks_%d_tags' % (count, cardinality)
+      results[key] = {
+        'recount_ms': recount * 1000,
+        'incremental_update_ms': incremental * 1000,
+        'sidebar_query_ms': sidebar * 1000,
+      }
+      print 'tags %-26s recount %8.1fms  update %6.2fms  sidebar %6.2fms' % (
+        key, recount * 1000, incremental * 1000, sidebar * 1000)
+  return results
+
+
+class AppServer(object):
+  """Runs app.py on a scratch database in a subprocess."""
+
+  def __init__(self, db):
+    self.tempdir = tempfile.mkdtemp()
+    config = {
+      'debug': False,
+      'cookie_secret': COOKIE_SECRET,
+      'mongodb_database': db.name,
+      'memcache_servers': [options.memcache_server],
+      'import_spool_dir': os.path.join(self.tempdir, 'spool'),
+      'writebehind_durability': options.writebehind_durability,
+      'writebehind_journal_dir': os.path.join(self.tempdir, 'writebehind'),
+    }
+    self.config_file = os.path.join(self.tempdir, 'app_config.yml')
+    with open(self.config_file, 'w') as f:
+      yaml.safe_dump(config, f)
+
+  def __enter__(self):
+    self.process = subprocess.Popen([
+      sys.executable, os.path.join(ROOT, 'app.py'),
+      '--port=%d' % options.app_port,
+      '--config_file=%s' % self.config_file,
+      '--logging=warning'])
+    deadline = time.time() + 30
+    while True:
+      try:
+        socket.create_connection(('127.0.0.1', options.app_port), 1).close()
+        break
+      except socket.error:
+        if time.time() > deadline or self.process.poll() is not None:
+          raise RuntimeError("app.py did not start")
+        time.sleep(0.1)
+    return self
+
+  def __exit__(self, *exc_info):
+    self.process.terminate()
+    self.process.wait()
+    shutil.rmtree(self.tempdir, ignore_errors=True)
+
+  def url(self, path):
+    return 'http://127.0.0.1:%d%s' % (options.app_port, path)
+
+
+def cookie_header(user_id):
+  value = tornado.web.create_signed_value(COOKIE_SECRET, 'user_id', str(user_id))
+  return {'Cookie': 'user_id=%s' % value}
+
+
+def bench_home(db):
+  clear(db)
+  user_id = make_user(db)._id
+  seed_bookmarks(db, user_id, options.home_bookmarks,
+                 [u'tag%d' % i for i in range(100)])
+  headers = cookie_header(user_id)
+  results = {}
+  with AppServer(db) as server:
+    client = tornado.httpclient.HTTPClient()
+    for depth in int_list(options.home_depths):
+      path = '/home'
+      if depth:
+        position = depth * PAGE_SIZE - 1
+        if position >= options.home_bookmarks:
+          continue
+        last = db.bookmarks.find_one(
+          {'user': user_id},
+          sort=[('modified', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)],
+          skip=position)
+        path += '?cursor=' + util.encode_cursor(last['modified'], last['_id'])
+      latencies = []
+      for i in range(options.home_requests):
+        started = time.time()
+        client.fetch(server.url(path), headers=headers)
+        latencies.append((time.time() - started) * 1000)
+      results['page_%d' % depth] = latency_summary(latencies)
+      print 'home page %5d: p50 %7.1fms  p99 %7.1fms' % (
+        depth, percentile(latencies, 0.5), percentile(latencies, 0.99))
+  return results
+
+
+@gen.coroutine
+def save_bookmarks(server, headers, count, concurrency):
+  client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+  latencies = []
+  urls = iter(range(count))
+
+  @gen.coroutine
+  def worker():
+    for i in urls:
+      url = server.url('/b?url=http%%3A//saved%d.example.com/page/%d&title=Page+%d'
+                       % (i % 500, i, i))
+      started = time.time()
+      yield client.fetch(url, headers=headers)
+      latencies.append((time.time() - started) * 1000)
+
+  yield [worker() for i in range(concurrency)]
+  raise gen.Return(latencies)
+
+
+def bench_bookmarklet(db):
+  clear(db)
+  user_id = make_user(db)._id
+  headers = cookie_header(user_id)
+  count = options.bookmarklet_saves
+  with AppServer(db) as server:
+    started = time.time()
+    latencies = tornado.ioloop.IOLoop.instance().run_sync(
+      lambda: save_bookmarks(server, headers, count,
+                             options.bookmarklet_concurrency))
+    acknowledged = time.time() - started
+    while db.bookmarks.find({'user': user_id}).count() < count:
+      if time.time() - started > 300:
+        raise RuntimeError("bookmarklet saves were not flushed")
+      time.sleep(0.05)
+    stored = time.time() - started
+  result = latency_summary(latencies)
+  result.update(saves=count,
+                durability=options.writebehind_durability,
+                saves_per_second=count / acknowledged,
+                seconds_until_stored=stored)
+  print 'bookmarklet %d saves: %.0f saves/s, p99 %.1fms, stored after %.2fs' % (
+    count, count / acknowledged, result['p99_ms'], stored)
+  return result
+
+
+def bench_retriever_throughput(db):
+  clear(db)
+  result = bench_retriever.measure(db)
+  print 'retriever %d urls: %.1f urls/s' % (result['tasks'], result['urls_per_second'])
+  return result
+
+
+# The retriever leaves timeouts on the shared IOLoop, so it runs last.
+BENCHMARKS = [
+  ('importer', bench_importer),
+  ('tags', bench_tags),
+  ('home', bench_home),
+  ('bookmarklet', bench_bookmarklet),
+  ('retriever', bench_retriever_throughput),
+]
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  tornado.options.parse_command_line()
+  selected = set(options.benchmarks.split(','))
+  unknown = selected - set(name for name, fn in BENCHMARKS)
+  if unknown:
+    raise ValueError("Unknown benchmarks: %s" % ', '.join(sorted(unknown)))
+
+  commit = git_commit()
+  report = {
+    'commit': commit,
+    'started': datetime.datetime.utcnow().isoformat(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'results': {},
+  }
+  connection = pymongo.Connection()
+  connection.drop_database(options.database)
+  db = connection[options.database]
+  try:
+    for name, fn in BENCHMARKS:
+      if name not in selected:
+        continue
+      try:
+        report['results'][name] = fn(db)
+      except Exception:
+        # Recorded, so the other benchmarks still run and get written.
+        print 'Benchmark %s failed:' % name
+        traceback.print_exc()
+        report['results'][name] = {'error': traceback.format_exc()}
+  finally:
+    connection.drop_database(options.database)
+
+  output = options.output
+  if output is None:
+    results_dir = os.path.join(ROOT, 'benchmarks', 'results')
+    if not os.path.isdir(results_dir):
+      os.makedirs(results_dir)
+    output = os.path.join(results_dir, '%s-%s.json' % (
+      datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'), (commit or 'unknown')[:10]))
+  with open(output, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+  print 'Results written to %s' % output
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,244 @@
+import collections
+import datetime
+import logging
+
+import pymongo
+import pymongo.errors
+
+import schema
+import search
+import tagcounts
+import urls
+import util
+
+# Fields a save may change on an existing bookmark. Everything else is only
+# written when the bookmark is first created.
+MUTABLE_FIELDS = ('title', 'description', 'tags')
+
+# Retrievers lease higher priority tasks first.
+PRIORITY_RECHECK = 0
+PRIORITY_RECHECK_ERROR = 1
+PRIORITY_NEW = 2
+
+# Write error codes of a unique index violation.
+DUPLICATE_KEY_CODES = (11000, 11001)
+# The key of a user's bookmark, which upserts select on. dedupe.py builds
+# its unique index.
+BOOKMARK_KEY = [('user', pymongo.ASCENDING), ('canonical_digest', pymongo.ASCENDING)]
+
+
+def has_unique_key_index(db):
+  keys = (BOOKMARK_KEY, schema.compact_fields(BOOKMARK_KEY))
+  return any(index.get('unique') and index['key'] in keys
+             for index in db.bookmarks.index_information().itervalues())
+
+
+def make_task(entry, priority=PRIORITY_NEW):
+  """Returns a retrieval task for a urls document."""
+  task = {
+    'url': entry['url'],
+    'canonical': entry['_id'],
+    'status': False,
+    'partition': util.task_partition(entry['url']),
+    'priority': priority,
+  }
+  # Validators from the last fetch make the retriever send a conditional
+  # request.
+  for key in ('etag', 'last_modified'):
+    if entry.get(key):
+      task[key] = entry[key]
+  return task
+
+
+def track_urls(db, user_id, bookmarks):
+  """
+  Queues retrieval tasks for the pages of newly saved bookmarks that no
+  bookmark had before, and gives the others the text already fetched.
+  """
+  created = urls.register(db, bookmarks)
+  if created:
+    db.tasks.insert([make_task(entry) for entry in created])
+  created = set(entry['_id'] for entry in created)
+  known = [b for b in bookmarks if urls.digest(b) not in created]
+  if known:
+    urls.copy_text(db, user_id, known)
+
+
+def upsert_bookmarks(db, user_id, bookmarks, retry_duplicates=True):
+  """
+  Saves bookmark dicts for one user as a single unordered bulk write of
+  upserts keyed on (user, canonical_digest), so urls that differ only in
+  scheme, www., trailing slash or tracking parameters, or that redirect to
+  a url the user already has, fold into one bookmark. Only the urls in
+  `bookmarks` are read back, to skip unchanged bookmarks and to compute tag
+  count deltas. Retrieval tasks are queued only for pages no bookmark of
+  any user had before.
+
+  An upsert racing another save of the same url violates the unique
+  (user, canonical_digest) index; those bookmarks are read back and saved
+  again, once.
+
+  Returns a dict with inserted, updated and unchanged counts.
+  """
+  stats = dict(inserted=0, updated=0, unchanged=0)
+  for bookmark in bookmarks:
+    bookmark.setdefault('canonical_digest', util.canonical_digest(bookmark['url']))
+  # Later entries for the same url win.
+  bookmarks = dict((b['canonical_digest'], b) for b in bookmarks).values()
+  if not bookmarks:
+    return stats
+
+  digests = [b['canonical_digest'] for b in bookmarks]
+  # Pages known to redirect to the saved urls, by the url they redirect to.
+  redirected = dict((e['_id'], e['redirect_digest']) for e in db.urls.find(
+      {'redirect_digest': {'$in': digests}}, fields=['redirect_digest']))
+  found = list(db.bookmarks.find(
+      {'user': user_id,
+       '$or': [{'canonical_digest': {'$in': digests + redirected.keys()}},
+               # Bookmarks saved before canonical digests were stored.
+               {'url_digest': {'$in': [b['url_digest'] for b in bookmarks]}}]},
+      fields=('url', 'canonical_digest') + MUTABLE_FIELDS))
+  existing = dict((urls.digest(b), b) for b in found)
+  # A bookmark saved under the url itself wins over one redirecting to it.
+  for source, target in redirected.iteritems():
+    if source in existing:
+      existing.setdefault(target, existing[source])
+
+  bulk = db.bookmarks.initialize_unordered_bulk_op()
+  operations = []
+  tag_changes = []
+  term_changes = []
+  now = datetime.datetime.now()
+  folded = set()
+  for bookmark in bookmarks:
+    old = existing.get(bookmark['canonical_digest'])
+    changes = dict((k, bookmark[k]) for k in MUTABLE_FIELDS if k in bookmark)
+    if old is not None:
+      if old['_id'] in folded:
+        # Both a url and its redirect target are in this batch.
+        stats['unchanged'] += 1
+        continue
+      folded.add(old['_id'])
+      if 'canonical_digest' not in old:
+        changes['canonical_digest'] = util.canonical_digest(old['url'])
+      if all(old.get(k) == v for k, v in changes.iteritems()):
+        stats['unchanged'] += 1
+        continue
+      tag_changes.append((old.get('tags'), changes.get('tags', old.get('tags'))))
+      term_changes.append((old, dict(old, **changes)))
+    else:
+      tag_changes.append((None, bookmark.get('tags')))
+      term_changes.append((None, bookmark))
+
+    on_insert = dict((k, v) for k, v in bookmark.iteritems()
+                     if k not in changes and k != '_id')
+    on_insert['user'] = user_id
+    on_insert.setdefault('modified', now)
+    update = {'$setOnInsert': on_insert}
+    if changes:
+      update['$set'] = changes
+    if old is not None:
+      selector = {'_id': old['_id']}
+    else:
+      selector = {'user': user_id, 'canonical_digest': bookmark['canonical_digest']}
+    bulk.find(selector).upsert().update_one(update)
+    operations.append(bookmark)
+
+  if not operations:
+    return stats
+
+  try:
+    result = bulk.execute()
+  except pymongo.errors.BulkWriteError as e:
+    result = e.details
+    if not retry_duplicates or any(error['code'] not in DUPLICATE_KEY_CODES
+                                   for error in result['writeErrors']):
+      raise
+  failed = set(error['index'] for error in result.get('writeErrors', []))
+  created = [operations[u['index']] for u in result.get('upserted', [])]
+  stats['inserted'] = len(created)
+  stats['updated'] = len(operations) - len(created) - len(failed)
+
+  delta = collections.defaultdict(int)
+  for i, (old_tags, new_tags) in enumerate(tag_changes):
+    if i not in failed:
+      tagcounts.accumulate(delta, old_tags, new_tags)
+  tagcounts.apply_delta(db, user_id, delta)
+  written = [change for i, change in enumerate(term_changes) if i not in failed]
+  search.change_terms(db, user_id,
+                      removed=[old for old, new in written if old is not None],
+                      added=[new for old, new in written])
+  if created:
+    track_urls(db, user_id, created)
+  if failed:
+    logging.info("Saving %d bookmarks again for %s after concurrent saves" % (
+      len(failed), user_id))
+    retried = upsert_bookmarks(db, user_id, [operations[i] for i in failed],
+                               retry_duplicates=False)
+    for key, count in retried.iteritems():
+      stats[key] += count
+  logging.debug("Upserted bookmarks for %s: %r" % (user_id, stats))
+  return stats
+
+
+def retag(db, user_id, query, update, change):
+  """
+  Runs `update` as one multi update over the user's bookmarks matching
+  `query` and adjusts tag counts by the same change. `change(tags)` must
+  return the tags a bookmark ends up with. Returns the number of bookmarks
+  matched.
+  """
+  query = dict(query, user=user_id)
+  delta = collections.defaultdict(int)
+  old, new = [], []
+  for bookmark in db.bookmarks.find(query, fields=search.VOCABULARY_FIELDS):
+    tags = change(bookmark.get('tags') or [])
+    tagcounts.accumulate(delta, bookmark.get('tags'), tags)
+    old.append(bookmark)
+    new.append(dict(bookmark, tags=tags))
+  if old:
+    db.bookmarks.update(query, update, multi=True)
+    tagcounts.apply_delta(db, user_id, delta)
+    search.change_terms(db, user_id, removed=old, added=new)
+  return len(old)
+
+
+def add_tags(db, user_id, ids, tags):
+  return retag(db, user_id, {'_id': {'$in': ids}},
+               {'$addToSet': {'tags': {'$each': tags}}},
+               lambda old: old + [t for t in tags if t not in old])
+
+
+def remove_tags(db, user_id, ids, tags):
+  return retag(db, user_id, {'_id': {'$in': ids}, 'tags': {'$in': tags}},
+               {'$pullAll': {'tags': tags}},
+               lambda old: [t for t in old if t not in tags])
+
+
+def rename_tag(db, user_id, old_name, new_name):
+  """Renames a tag on all of the user's bookmarks. Returns the number of
+  bookmarks changed."""
+  if old_name == new_name:
+    return 0
+  # Bookmarks that already carry the new name only lose the old one...
+  merged = retag(db, user_id, {'tags': {'$all': [old_name, new_name]}},
+                 {'$pull': {'tags': old_name}},
+                 lambda old: [t for t in old if t != old_name])
+  # ...the rest have it replaced in place.
+  renamed = retag(db, user_id, {'tags': old_name},
+                  {'$set': {'tags.$': new_name}},
+                  lambda old: [new_name if t == old_name else t for t in old])
+  return merged + renamed
+
+
+def delete_bookmarks(db, user_id, ids):
+  """Deletes bookmarks by id. Returns the number deleted."""
+  query = {'user': user_id, '_id': {'$in': ids}}
+  delta = collections.defaultdict(int)
+  deleted = list(db.bookmarks.find(query, fields=search.VOCABULARY_FIELDS))
+  for bookmark in deleted:
+    tagcounts.accumulate(delta, bookmark.get('tags'), None)
+  db.bookmarks.remove(query)
+  tagcounts.apply_delta(db, user_id, delta)
+  search.remove_terms(db, user_id, deleted)
+  return len(deleted)
@@ -0,0 +1,231 @@
+import collections
+import logging
+import time
+
+import pylibmc
+
+
+class LRUCache(object):
+  """
+  In-process least recently used cache whose entries expire after `ttl`
+  seconds. Keeps hit and miss counters.
+  """
+  def __init__(self, max_size=10000, ttl=30):
+    self.max_size = max_size
+    self.ttl = ttl
+    self.data = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, default=None):
+    try:
+      expires, value = self.data.pop(key)
+    except KeyError:
+      self.misses += 1
+      return default
+    if expires < time.time():
+      self.misses += 1
+      return default
+    self.data[key] = (expires, value)
+    self.hits += 1
+    return value
+
+  def set(self, key, value, ttl=None):
+    self.data.pop(key, None)
+    self.data[key] = (time.time() + (ttl or self.ttl), value)
+    while len(self.data) > self.max_size:
+      self.data.popitem(last=False)
+
+  def delete(self, key):
+    self.data.pop(key, None)
+
+  def clear(self):
+    self.data.clear()
+
+
+class TieredCache(object):
+  """
+  An LRUCache in front of memcache. Reads try the local cache first and
+  fill it from memcache; writes and deletes go to both. A delete only
+  reaches the local cache of this process, so other processes may serve
+  the old value until their local entry expires.
+
+  Memcache errors are logged and treated as misses.
+  """
+  def __init__(self, memcache, local=None, ttl=0):
+    self.memcache = memcache
+    self.local = local if local is not None else LRUCache()
+    self.ttl = ttl
+    self.remote_hits = 0
+    self.remote_misses = 0
+
+  def get(self, key):
+    value = self.local.get(key)
+    if value is not None:
+      return value
+    return self.get_multi([key]).get(key)
+
+  def get_multi(self, keys, fresh=()):
+    """Returns a dict of the found keys, with one memcache round trip for
+    all local misses. Keys in `fresh` are always read from memcache."""
+    found = {}
+    missing = list(fresh)
+    for key in keys:
+      value = self.local.get(key)
+      if value is None:
+        missing.append(key)
+      else:
+        found[key] = value
+    if missing:
+      try:
+        remote = self.memcache.get_multi(missing)
+      except pylibmc.Error:
+        logging.exception("memcache get_multi failed")
+        remote = {}
+      self.remote_hits += len(remote)
+      self.remote_misses += len(missing) - len(remote)
+      for key, value in remote.iteritems():
+        self.local.set(key, value)
+      found.update(remote)
+    return found
+
+  def set(self, key, value, ttl=None):
+    self.local.set(key, value)
+    try:
+      self.memcache.set(key, value, time=ttl or self.ttl)
+    except pylibmc.Error:
+      logging.exception("memcache set failed")
+
+  def delete(self, key):
+    self.local.delete(key)
+    try:
+      self.memcache.delete(key)
+    except pylibmc.Error:
+      logging.exception("memcache delete failed")
+
+  def stats(self):
+    return {
+      'local_hits': self.local.hits,
+      'local_misses': self.local.misses,
+      'local_size': len(self.local.data),
+      'remote_hits': self.remote_hits,
+      'remote_misses': self.remote_misses,
+    }
+
+
+def user_key(user_id):
+  return 'user/%s' % user_id
+
+
+def memcache_client(servers):
+  return pylibmc.Client(
+    servers, binary=True, behaviors={"tcp_nodelay": True, "ketama": True})
+
+
+def generation_key(user_id):
+  return 'gen/%s' % user_id
+
+
+def new_generation():
+  # Starting from the clock means a generation counter that was evicted
+  # never comes back with a value that was already used.
+  return int(time.time() * 1000)
+
+
+def bump_generation(memcache, user_id):
+  """
+  Invalidates every cached value derived from the user's bookmarks. Call
+  after any bookmark mutation.
+  """
+  key = generation_key(user_id)
+  try:
+    try:
+      memcache.incr(key)
+    except pylibmc.NotFound:
+      memcache.add(key, new_generation())
+  except pylibmc.Error:
+    logging.exception("Could not bump cache generation for %s" % user_id)
+
+
+class UserCache(object):
+  """
+  Values derived from one user's bookmarks, such as popular tags, the first
+  listing page or counts. They are cached under the user's current
+  generation, so bump_generation makes all of them unreachable at once and
+  nothing is ever served stale.
+
+  Reads are batched: get_multi fetches the generation together with the
+  values stored under the generation this process saw last, which is one
+  memcache round trip unless the generation has moved on.
+  """
+  TTL = 24 * 60 * 60
+
+  def __init__(self, cache, user_id):
+    self.cache = cache
+    self.user_id = user_id
+    self.generation = None
+    self.values = {}
+
+  def key(self, generation, name):
+    return '%s/%s/%s' % (self.user_id, generation, name)
+
+  def get_multi(self, names):
+    names = [name for name in names if name not in self.values]
+    if not names:
+      return
+    if self.generation is None:
+      found = self.load(names)
+    else:
+      found = self.cache.get_multi([self.key(self.generation, name)
+                                    for name in names])
+    for name in names:
+      key = self.key(self.generation, name)
+      if key in found:
+        self.values[name] = found[key]
+
+  def load(self, names):
+    """
+    Reads the current generation and returns the values of `names` under
+    it, guessing that the generation has not changed since this process
+    last saw it.
+    """
+    gen_key = generation_key(self.user_id)
+    guess = self.cache.local.get(gen_key)
+    keys = []
+    if guess is not None:
+      keys = [self.key(guess, name) for name in names]
+    found = self.cache.get_multi(keys, fresh=[gen_key])
+    self.generation = found.pop(gen_key, None)
+    if self.generation is None:
+      # Nothing can be cached under a brand new generation.
+      self.generation = new_generation()
+      found = {}
+      try:
+        if not self.cache.memcache.add(gen_key, self.generation):
+          self.generation = self.cache.memcache.get(gen_key) or self.generation
+          guess = None
+        else:
+          guess = self.generation
+      except pylibmc.Error:
+        logging.exception("Could not initialize cache generation")
+        guess = self.generation
+    self.cache.local.set(gen_key, self.generation)
+    if self.generation == guess or not names:
+      return found
+    return self.cache.get_multi([self.key(self.generation, name)
+                                 for name in names])
+
+  def current_generation(self):
+    if self.generation is None:
+      self.load([])
+    return self.generation
+
+  def get(self, name):
+    self.get_multi([name])
+    return self.values.get(name)
+
+  def set(self, name, value):
+    if self.generation is None:
+      self.load([])
+    self.values[name] = value
+    self.cache.set(self.key(self.generation, name), value, ttl=self.TTL)
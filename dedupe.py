@@ -0,0 +1,95 @@
+"""
+Stores canonical url digests on bookmarks saved before they existed and
+merges each user's bookmarks that share a canonical url into the oldest
+one, with the union of their tags. Once every user is done, the
+(user, canonical_digest) index is rebuilt as a unique index; until then
+the app logs a warning at startup.
+
+  python dedupe.py --config_file=app_config.yml [--email=...] [--dry_run]
+"""
+import collections
+import logging
+
+import pymongo
+import tornado.options
+from tornado.options import define, options
+
+import bulk
+import schema
+import search
+import tagcounts
+import util
+
+
+def dedupe(db, user_id, dry_run=False):
+  """Returns (backfilled, merged) counts for one user."""
+  groups = collections.defaultdict(list)
+  backfill = db.bookmarks.initialize_unordered_bulk_op()
+  backfilled = 0
+  for bookmark in db.bookmarks.find(
+      {'user': user_id}, fields=('url', 'canonical_digest') + search.VOCABULARY_FIELDS,
+      sort=[('modified', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]):
+    canonical = bookmark.get('canonical_digest')
+    if canonical is None:
+      canonical = util.canonical_digest(bookmark['url'])
+      backfill.find({'_id': bookmark['_id']}) \
+          .update_one({'$set': {'canonical_digest': canonical}})
+      backfilled += 1
+    groups[canonical].append(bookmark)
+  if backfilled and not dry_run:
+    backfill.execute()
+
+  merged = 0
+  for duplicates in groups.itervalues():
+    if len(duplicates) < 2:
+      continue
+    kept, removed = duplicates[0], duplicates[1:]
+    merged += len(removed)
+    if dry_run:
+      logging.info("Would merge %s into %s" % (
+        ', '.join(b['url'] for b in removed), kept['url']))
+      continue
+    tags = list(kept.get('tags') or [])
+    for bookmark in removed:
+      tags.extend(t for t in bookmark.get('tags') or [] if t not in tags)
+    if tags != (kept.get('tags') or []):
+      db.bookmarks.update({'_id': kept['_id']}, {'$set': {'tags': tags}})
+    db.bookmarks.remove({'_id': {'$in': [b['_id'] for b in removed]}})
+    search.change_terms(db, user_id, removed=removed + [kept],
+                        added=[dict(kept, tags=tags)])
+  if merged and not dry_run:
+    tagcounts.reconcile(db, user_id)
+  return backfilled, merged
+
+
+def ensure_unique_index(db):
+  """Replaces a plain (user, canonical_digest) index with a unique one."""
+  try:
+    db.bookmarks.drop_index(bulk.BOOKMARK_KEY)
+  except pymongo.errors.OperationFailure:
+    # There was none.
+    pass
+  db.bookmarks.ensure_index(bulk.BOOKMARK_KEY, unique=True)
+
+
+def main():
+  define("config_file", default="app_config.yml", help="app_config file")
+  define("email", default=None, help="dedupe only this user")
+  define("dry_run", default=False, type=bool,
+         help="log the merges without writing anything")
+  tornado.options.parse_command_line()
+  config = util.load_config(options.config_file)
+  db = schema.wrap(pymongo.Connection()[config.mongodb_database], config)
+  query = {}
+  if options.email:
+    query['email'] = options.email
+  for user in db.users.find(query, fields=['email']):
+    backfilled, merged = dedupe(db, user['_id'], options.dry_run)
+    logging.info("%s: stored %d canonical digests, merged %d duplicates" % (
+      user['email'], backfilled, merged))
+  if not options.email and not options.dry_run:
+    ensure_unique_index(db)
+    logging.info("Created the unique (user, canonical_digest) index")
+
+if __name__ == '__main__':
+  main()
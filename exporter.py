@@ -0,0 +1,130 @@
+import json
+import sys
+import time
+import zlib
+
+import pymongo
+import tornado.options
+from tornado.escape import xhtml_escape
+from tornado.options import define, options
+
+import schema
+import util
+
+NETSCAPE_HEADER = '''<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<TITLE>Bookmarks</TITLE>
+<H1>Bookmarks</H1>
+<DL><p>
+'''
+NETSCAPE_FOOTER = '</DL><p>\n'
+
+FORMATS = {
+  'html': ('text/html; charset=UTF-8', 'html'),
+  'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+
+class Exporter(object):
+  """
+  Exports a user's bookmarks as a Netscape bookmark file, which Importer
+  reads back, or as JSON lines. `chunks` reads the cursor `batch_size`
+  bookmarks at a time and yields one encoded, optionally gzipped, chunk per
+  batch, so memory use does not grow with the library.
+  """
+  BATCH_SIZE = 500
+  FIELDS = ('url', 'title', 'description', 'tags', 'modified')
+
+  def __init__(self, db, user_id, format='html', compress=False, batch_size=None):
+    if format not in FORMATS:
+      raise ValueError("Unknown export format %r" % format)
+    self.db = db
+    self.user_id = user_id
+    self.format = format
+    self.compress = compress
+    self.batch_size = batch_size or self.BATCH_SIZE
+
+  @property
+  def content_type(self):
+    if self.compress:
+      return 'application/gzip'
+    return FORMATS[self.format][0]
+
+  @property
+  def filename(self):
+    name = 'bookmarks.%s' % FORMATS[self.format][1]
+    return name + '.gz' if self.compress else name
+
+  def chunks(self):
+    # wbits 31 writes a gzip container rather than a raw zlib stream.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if self.compress else None
+    encode = compressor.compress if compressor else lambda data: data
+
+    if self.format == 'html':
+      yield encode(NETSCAPE_HEADER)
+    cursor = self.db.bookmarks.find(
+      {'user': self.user_id}, fields=self.FIELDS,
+      sort=[('modified', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+    ).batch_size(self.batch_size)
+    try:
+      batch = []
+      for bookmark in cursor:
+        batch.append(self.format_bookmark(bookmark))
+        if len(batch) == self.batch_size:
+          yield encode(''.join(batch))
+          batch = []
+      if batch:
+        yield encode(''.join(batch))
+    finally:
+      cursor.close()
+    tail = encode(NETSCAPE_FOOTER) if self.format == 'html' else ''
+    if compressor:
+      tail += compressor.flush()
+    if tail:
+      yield tail
+
+  def format_bookmark(self, bookmark):
+    if self.format == 'ndjson':
+      return json.dumps(dict(
+        url=bookmark['url'],
+        title=bookmark.get('title'),
+        description=bookmark.get('description'),
+        tags=bookmark.get('tags') or [],
+        modified=bookmark['modified'].isoformat() if bookmark.get('modified') else None,
+      )) + '\n'
+
+    attributes = 'HREF="%s"' % xhtml_escape(bookmark['url'])
+    if bookmark.get('modified'):
+      # Importer reads ADD_DATE back as local time.
+      attributes += ' ADD_DATE="%d"' % time.mktime(bookmark['modified'].timetuple())
+    if bookmark.get('tags'):
+      attributes += ' TAGS="%s"' % xhtml_escape(u','.join(bookmark['tags']))
+    line = u'<DT><A %s>%s</A>\n' % (attributes, xhtml_escape(bookmark.get('title') or bookmark['url']))
+    if bookmark.get('description'):
+      line += u'<DD>%s\n' % xhtml_escape(bookmark['description'])
+    return line.encode('utf8')
+
+
+def main():
+  define("config_file", default="app_config.yml", help="app_config file")
+  define("email", default=None, help="user whose bookmarks to export")
+  define("format", default="html", help="html or ndjson")
+  define("gzip", default=False, type=bool)
+  define("output", default=None, help="output file, defaults to stdout")
+  tornado.options.parse_command_line()
+  config = util.load_config(options.config_file)
+  db = schema.wrap(pymongo.Connection()[config.mongodb_database], config)
+  user = db.users.find_one({'email': options.email}, fields=['_id'])
+  if user is None:
+    sys.exit("No user with email %s" % options.email)
+  exporter = Exporter(db, user['_id'], options.format, options.gzip)
+  output = open(options.output, 'wb') if options.output else sys.stdout
+  try:
+    for chunk in exporter.chunks():
+      output.write(chunk)
+  finally:
+    if options.output:
+      output.close()
+
+if __name__ == '__main__':
+  main()
@@ -14,6 +14,10 @@ class BaseForm(Form):
         formdata.setlist(name, handler.get_arguments(name))
     Form.__init__(self, formdata, obj=obj, prefix=prefix, **kwargs)
 
+def clean_tags(tags):
+  """Lowercases, strips, dedupes and sorts tag names, dropping empty ones."""
+  return sorted(set(t.strip().lower() for t in tags if t.strip()))
+
 class TagListField(wtforms.fields.Field):
   widget = wtforms.widgets.TextInput()
 
@@ -24,8 +28,7 @@ class TagListField(wtforms.fields.Field):
 
   def process_formdata(self, valuelist):
     if valuelist:
-      self.data = list(set(x.strip().lower() for x in valuelist[0].strip().split(',')))
-      self.data.sort()
+      self.data = clean_tags(valuelist[0].split(','))
     else:
       self.data = []
 
@@ -0,0 +1,115 @@
+import datetime
+import logging
+import os
+import socket
+import time
+import traceback
+
+import pymongo
+
+import tornado.process
+import tornado.util
+from tornado.options import define, options
+define("config_file", default="app_config.yml", help="app_config file")
+define("processes", default=1, type=int,
+       help="number of worker processes to fork, 0 for one per cpu")
+define("poll_interval", default=2.0, type=float,
+       help="seconds to wait when the job queue is empty")
+define("job_timeout", default=600, type=int,
+       help="seconds without progress before a running job is reclaimed")
+define("metrics_port", default=0, type=int,
+       help="serve metrics on this port, plus the worker number; 0 to disable")
+
+import cache
+import importer
+import metrics
+import schema
+import util
+
+
+JOBS = metrics.counter('import_jobs_total', 'Finished import jobs.',
+                       labels=('state',))
+JOB_SECONDS = metrics.histogram('import_job_seconds', 'Duration of import jobs.',
+                                buckets=(1, 5, 15, 60, 300, 900, 3600))
+
+
+class ImportWorker(object):
+  def __init__(self):
+    self.config = util.load_config(options.config_file)
+    self.conn = pymongo.Connection()
+    self.db = schema.wrap(
+      metrics.InstrumentedDatabase(self.conn[self.config.mongodb_database]),
+      self.config)
+    self.memcache = cache.memcache_client(self.config.memcache_servers)
+    self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+
+  def claim(self):
+    now = datetime.datetime.now()
+    stale = now - datetime.timedelta(seconds=options.job_timeout)
+    return self.db.import_jobs.find_and_modify(
+      query={'$or': [{'state': 'queued'},
+                     {'state': 'running', 'heartbeat': {'$lt': stale}}]},
+      update={'$set': {'state': 'running', 'worker': self.name,
+                       'started': now, 'heartbeat': now}},
+      sort={'created': pymongo.ASCENDING},
+      new=True)
+
+  def process(self, job):
+    owner = self.db.users.find_one({'_id': job['user']})
+    if owner is None:
+      raise ValueError("Unknown user %s" % job['user'])
+
+    def progress(stats):
+      cache.bump_generation(self.memcache, owner['_id'])
+      self.db.import_jobs.update(
+        {'_id': job['_id']},
+        {'$set': {'stats': stats, 'heartbeat': datetime.datetime.now()}})
+
+    with open(job['path'], 'rb') as f:
+      return importer.Importer(self.db, tornado.util.ObjectDict(owner), f,
+                               progress=progress).import_bookmarks()
+
+  def run(self):
+    logging.info("Import worker %s started" % self.name)
+    while True:
+      job = self.claim()
+      if job is None:
+        time.sleep(options.poll_interval)
+        continue
+
+      logging.info("Importing job %s" % job['_id'])
+      started = time.time()
+      try:
+        stats = self.process(job)
+      except Exception:
+        logging.exception("Import job %s failed" % job['_id'])
+        JOBS.inc(state='failed')
+        self.db.import_jobs.update(
+          {'_id': job['_id']},
+          {'$set': {'state': 'failed', 'error': traceback.format_exc(),
+                    'finished': datetime.datetime.now()}})
+        continue
+
+      self.db.import_jobs.update(
+        {'_id': job['_id']},
+        {'$set': {'state': 'done', 'stats': stats,
+                  'finished': datetime.datetime.now()}})
+      JOBS.inc(state='done')
+      JOB_SECONDS.observe(time.time() - started)
+      try:
+        os.remove(job['path'])
+      except OSError:
+        pass
+
+
+def main():
+  tornado.options.parse_command_line()
+  task_id = 0
+  if options.processes != 1:
+    task_id = tornado.process.fork_processes(options.processes)
+  if options.metrics_port:
+    metrics.start_http_server(options.metrics_port + task_id)
+  ImportWorker().run()
+
+if __name__ == '__main__':
+  main()
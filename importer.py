@@ -1,65 +1,197 @@
+import codecs
 import datetime
-import hashlib
+import HTMLParser
 import logging
-from lxml import etree
-from pymongo.objectid import ObjectId
+import os
+from cStringIO import StringIO
+from bson.objectid import ObjectId
 from bson.dbref import DBRef
 
+import bulk
+import metrics
+import util
+
+IMPORTED = metrics.counter('importer_bookmarks_total',
+                           'Imported bookmarks by outcome.', labels=('result',))
+BATCH_SECONDS = metrics.histogram('importer_batch_seconds',
+                                  'Time to write one import batch.')
+
+def enqueue(db, user_id, spool_dir, contents):
+  """
+  Spools an uploaded bookmark file to disk and queues an import job for
+  import_worker.py. Returns the job id.
+  """
+  job_id = ObjectId()
+  if not os.path.isdir(spool_dir):
+    os.makedirs(spool_dir)
+  path = os.path.join(spool_dir, '%s.html' % job_id)
+  with open(path, 'wb') as f:
+    f.write(contents)
+  db.import_jobs.insert({
+    '_id': job_id,
+    'user': user_id,
+    'path': os.path.abspath(path),
+    'state': 'queued',
+    'created': datetime.datetime.now(),
+    'stats': dict(parsed=0, inserted=0, duplicates=0, skipped=0),
+  })
+  return job_id
+
+class NetscapeParser(HTMLParser.HTMLParser):
+  """
+  Tokenizes a Netscape bookmark file fed in chunks without building a
+  tree. Finished bookmarks collect in `bookmarks` until the caller takes
+  them; besides those the parser only holds the link being read and the
+  unparsed tail of the last chunk.
+  """
+  def __init__(self, make_bookmark):
+    HTMLParser.HTMLParser.__init__(self)
+    self.make_bookmark = make_bookmark
+    self.bookmarks = []
+    self.pending = None
+    # 'a' or 'dd' while reading the text of a link or a description.
+    self.reading = None
+    self.attrs = None
+    self.text = []
+
+  def handle_starttag(self, tag, attrs):
+    self.end_text()
+    if tag == 'a':
+      self.flush()
+      self.reading, self.attrs = 'a', dict(attrs)
+    elif tag == 'dd':
+      self.reading = 'dd'
+    elif tag == 'h3':
+      # Folder titles may carry their own <dd> description.
+      self.flush()
+
+  def handle_endtag(self, tag):
+    self.end_text()
+
+  def handle_data(self, data):
+    if self.reading is not None:
+      self.text.append(data)
+
+  def handle_entityref(self, name):
+    self.handle_data(self.unescape('&%s;' % name))
+
+  def handle_charref(self, name):
+    self.handle_data(self.unescape('&#%s;' % name))
+
+  def end_text(self):
+    if self.reading is None:
+      return
+    text = u''.join(self.text).strip() or None
+    if self.reading == 'a':
+      self.pending = self.make_bookmark(self.attrs, text)
+    elif self.pending is not None:
+      if text:
+        self.pending['description'] = text
+      self.flush()
+    self.reading, self.attrs, self.text = None, None, []
+
+  def flush(self):
+    if self.pending is not None:
+      self.bookmarks.append(self.pending)
+      self.pending = None
+
+  def close(self):
+    HTMLParser.HTMLParser.close(self)
+    self.end_text()
+    self.flush()
+
+
 class Importer(object):
-  def __init__(self, db, owner, contents):
+  """
+  Imports a Netscape bookmark file. The file is parsed incrementally and
+  written in batches of `batch_size` bookmarks, so memory use does not grow
+  with the size of the file. `contents` may be a string or a file object.
+
+  Progress is kept in `stats` and, if given, `progress` is called with it
+  after every batch.
+  """
+  BATCH_SIZE = 1000
+  CHUNK_SIZE = 64 * 1024
+
+  def __init__(self, db, owner, contents, batch_size=None, progress=None):
     self.db = db
     self.owner = owner
     self.contents = contents
+    self.batch_size = batch_size or self.BATCH_SIZE
+    self.progress = progress
+    self.stats = dict(parsed=0, inserted=0, duplicates=0, skipped=0)
 
   def import_bookmarks(self):
-    collection = self.db.bookmarks
-    url_digests = dict((b['url_digest'], b['_id'])
-        for b in collection.find({'user': self.owner._id}, fields=['url_digest']))
-    root = etree.fromstring(self.contents, etree.HTMLParser())
-    bookmarks = list()
-
-    for link in root.xpath('//a'):
-      url = link.attrib.get('href')
-
-      if not url or not url.startswith('http'):
-        continue
-
-      title = link.text
-      url_digest = hashlib.md5(url.encode('utf8')).hexdigest()
-
-      bookmark = {
-	      "user" : self.owner._id,
-	      'url': url,
-	      'url_digest': url_digest,
-	      'title': title or url,
-      }
-
-      if url_digest in url_digests:
-        bookmark['_id'] = url_digests[url_digest]
-
-      if 'add_date' in link.attrib:
-        try:
-          bookmark['modified'] = datetime.datetime.fromtimestamp(float(link.attrib['add_date']))
-        except:
-          pass
-
-      if 'tags' in link.attrib:
-        bookmark['tags'] = link.attrib['tags'].split(',')
-
-      description_tag = link.getparent().getnext()
-      if description_tag is not None and description_tag.tag == 'dd':
-        bookmark['description'] = description_tag.text
-
-      bookmarks.append(bookmark)
-
-    if bookmarks:
-      collection.insert(bookmarks)
-      tasks = []
-      for bookmark in bookmarks:
-        tasks.append({
-          'url': bookmark['url'],
-          'user': self.owner._id,
-          'bookmark': bookmark['url_digest'],
-          'status': False,
-        })
-      self.db.tasks.insert(tasks)
+    source = self.contents
+    if isinstance(source, basestring):
+      source = StringIO(source)
+
+    batch = []
+    for bookmark in self.parse(source):
+      batch.append(bookmark)
+      if len(batch) >= self.batch_size:
+        self.import_batch(batch)
+        batch = []
+    if batch:
+      self.import_batch(batch)
+    logging.info("Imported bookmarks for %s: %r" % (self.owner._id, self.stats))
+    return self.stats
+
+  def parse(self, source):
+    """
+    Yields bookmark dicts from a Netscape bookmark file, read and tokenized
+    CHUNK_SIZE bytes at a time.
+    """
+    parser = NetscapeParser(self.make_bookmark)
+    decoder = codecs.getincrementaldecoder('utf8')('replace')
+    while True:
+      chunk = source.read(self.CHUNK_SIZE)
+      parser.feed(decoder.decode(chunk, final=not chunk))
+      if not chunk:
+        parser.close()
+      for bookmark in parser.bookmarks:
+        yield bookmark
+      del parser.bookmarks[:]
+      if not chunk:
+        break
+
+  def make_bookmark(self, attrs, title):
+    url = attrs.get('href')
+
+    if not url or not url.startswith('http'):
+      self.stats['skipped'] += 1
+      IMPORTED.inc(result='skipped')
+      return None
+
+    self.stats['parsed'] += 1
+    url_digest = util.md5(url)
+
+    bookmark = {
+      "user" : self.owner._id,
+      'url': url,
+      'url_digest': url_digest,
+      'canonical_digest': util.canonical_digest(url),
+      'title': title or url,
+    }
+
+    if attrs.get('add_date'):
+      try:
+        bookmark['modified'] = datetime.datetime.fromtimestamp(float(attrs['add_date']))
+      except ValueError:
+        pass
+
+    if attrs.get('tags'):
+      bookmark['tags'] = attrs['tags'].split(',')
+
+    return bookmark
+
+  def import_batch(self, bookmarks):
+    with BATCH_SECONDS.time():
+      stats = bulk.upsert_bookmarks(self.db, self.owner._id, bookmarks)
+    self.stats['inserted'] += stats['inserted']
+    self.stats['duplicates'] += stats['updated'] + stats['unchanged']
+    IMPORTED.inc(len(bookmarks), result='parsed')
+    IMPORTED.inc(stats['inserted'], result='inserted')
+    IMPORTED.inc(stats['updated'] + stats['unchanged'], result='duplicate')
+    if self.progress is not None:
+      self.progress(self.stats)
@@ -0,0 +1,320 @@
+"""
+Process-local counters, gauges and histograms rendered in the Prometheus
+text format.
+
+Metrics live in the process that records them. Under the pre-forked server
+a scrape of /metrics reaches whichever worker accepts it, so scrape each
+worker on its own port or treat the numbers as a sample. The retriever and
+the import worker serve their metrics with --metrics_port, one port per
+forked worker starting at that port.
+"""
+import BaseHTTPServer
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+import pymongo.cursor
+import pymongo.database
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def escape(value):
+  return unicode(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_sample(name, labels, value):
+  if labels:
+    name += '{%s}' % ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+  return u'%s %s' % (name, repr(float(value)))
+
+
+class Metric(object):
+  type = None
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def key(self, labels):
+    if set(labels) != set(self.labels):
+      raise ValueError("%s takes labels %r, got %r" % (self.name, self.labels, labels.keys()))
+    return tuple(labels[l] for l in self.labels)
+
+  def samples(self):
+    with self.lock:
+      items = self.values.items()
+    for key, value in sorted(items):
+      yield self.name, zip(self.labels, key), value
+
+
+class Counter(Metric):
+  type = 'counter'
+
+  def inc(self, amount=1, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+  type = 'gauge'
+
+  def set(self, value, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = value
+
+
+class Callback(Metric):
+  """Reads its values when rendered. `fn` returns a number or, for labeled
+  metrics, a dict of label value tuples to numbers."""
+  def __init__(self, name, help, type, fn, labels=()):
+    Metric.__init__(self, name, help, labels)
+    self.type = type
+    self.fn = fn
+
+  def samples(self):
+    try:
+      values = self.fn()
+    except Exception:
+      logging.exception("Could not read metric %s" % self.name)
+      return
+    if not self.labels:
+      values = {(): values}
+    for key, value in sorted(values.items()):
+      yield self.name, zip(self.labels, key), value
+
+
+class Histogram(Metric):
+  type = 'histogram'
+
+  def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    Metric.__init__(self, name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    key = self.key(labels)
+    i = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+      counts[i] += 1
+      self.values[key] = (counts, total + value)
+
+  @contextlib.contextmanager
+  def time(self, **labels):
+    started = time.time()
+    try:
+      yield
+    finally:
+      self.observe(time.time() - started, **labels)
+
+  def samples(self):
+    with self.lock:
+      items = [(k, (list(c), t)) for k, (c, t) in self.values.items()]
+    for key, (counts, total) in sorted(items):
+      labels = zip(self.labels, key)
+      cumulative = 0
+      for bound, count in zip(self.buckets + (float('inf'),), counts):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        yield self.name + '_bucket', labels + [('le', le)], cumulative
+      yield self.name + '_sum', labels, total
+      yield self.name + '_count', labels, cumulative
+
+
+class Registry(object):
+  def __init__(self):
+    self.metrics = {}
+    self.lock = threading.Lock()
+
+  def register(self, metric):
+    # Registering a name again returns the first metric, so modules and
+    # objects created more than once per process share their metrics.
+    with self.lock:
+      return self.metrics.setdefault(metric.name, metric)
+
+  def counter(self, name, help, labels=()):
+    return self.register(Counter(name, help, labels))
+
+  def gauge(self, name, help, labels=()):
+    return self.register(Gauge(name, help, labels))
+
+  def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return self.register(Histogram(name, help, labels, buckets))
+
+  def callback(self, name, help, type, fn, labels=()):
+    """Registers, or replaces, a metric read from `fn` at render time."""
+    metric = Callback(name, help, type, fn, labels)
+    with self.lock:
+      self.metrics[name] = metric
+    return metric
+
+  def render(self):
+    with self.lock:
+      metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+      lines.append(u'# HELP %s %s' % (metric.name, metric.help))
+      lines.append(u'# TYPE %s %s' % (metric.name, metric.type))
+      for name, labels, value in metric.samples():
+        lines.append(format_sample(name, labels, value))
+    return u'\n'.join(lines).encode('utf8') + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+callback = REGISTRY.callback
+
+
+MONGO_SECONDS = histogram('mongo_operation_seconds',
+                          'Duration of Mongo operations.',
+                          labels=('collection', 'operation'))
+MONGO_ERRORS = counter('mongo_errors_total', 'Mongo operations that raised.',
+                       labels=('collection', 'operation'))
+
+
+class InstrumentedDatabase(object):
+  """
+  Wraps a pymongo Database so every collection operation is counted and
+  timed in mongo_operation_seconds. A find is timed over the whole
+  iteration of its cursor and recorded once the cursor is exhausted or
+  counted. Bulk operations are timed on execute.
+
+  Code that needs a real Database, such as GridFS, should use `database`.
+  """
+  def __init__(self, database):
+    self.database = database
+
+  def __getattr__(self, name):
+    if name.startswith('_') or hasattr(pymongo.database.Database, name):
+      return getattr(self.database, name)
+    return InstrumentedCollection(self.database[name])
+
+  def __getitem__(self, name):
+    return InstrumentedCollection(self.database[name])
+
+
+class InstrumentedCollection(object):
+  def __init__(self, collection):
+    self.collection = collection
+
+  def __getattr__(self, name):
+    attr = getattr(self.collection, name)
+    if not callable(attr):
+      return attr
+    collection = self.collection.name
+
+    def call(*args, **kwargs):
+      started = time.time()
+      try:
+        result = attr(*args, **kwargs)
+      except Exception:
+        MONGO_ERRORS.inc(collection=collection, operation=name)
+        raise
+      if isinstance(result, pymongo.cursor.Cursor):
+        return InstrumentedCursor(result, collection, name, time.time() - started)
+      if name.startswith('initialize_') and name.endswith('_bulk_op'):
+        return InstrumentedBulk(result, collection)
+      MONGO_SECONDS.observe(time.time() - started, collection=collection,
+                            operation=name)
+      return result
+    return call
+
+
+class InstrumentedCursor(object):
+  def __init__(self, cursor, collection, operation, elapsed=0.0):
+    self.cursor = cursor
+    self.collection = collection
+    self.operation = operation
+    self.elapsed = elapsed
+    self.recorded = False
+
+  def record(self):
+    if not self.recorded:
+      self.recorded = True
+      MONGO_SECONDS.observe(self.elapsed, collection=self.collection,
+                            operation=self.operation)
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    started = time.time()
+    try:
+      document = self.cursor.next()
+    except StopIteration:
+      self.elapsed += time.time() - started
+      self.record()
+      raise
+    except Exception:
+      MONGO_ERRORS.inc(collection=self.collection, operation=self.operation)
+      raise
+    self.elapsed += time.time() - started
+    return document
+
+  def count(self, *args, **kwargs):
+    started = time.time()
+    result = self.cursor.count(*args, **kwargs)
+    self.elapsed += time.time() - started
+    self.record()
+    return result
+
+  def __getattr__(self, name):
+    attr = getattr(self.cursor, name)
+    if not callable(attr):
+      return attr
+
+    def call(*args, **kwargs):
+      result = attr(*args, **kwargs)
+      # sort(), limit() and friends return the cursor itself.
+      return self if result is self.cursor else result
+    return call
+
+
+class InstrumentedBulk(object):
+  def __init__(self, bulk, collection):
+    self.bulk = bulk
+    self.collection = collection
+
+  def execute(self, *args, **kwargs):
+    with MONGO_SECONDS.time(collection=self.collection, operation='bulk'):
+      return self.bulk.execute(*args, **kwargs)
+
+  def __getattr__(self, name):
+    return getattr(self.bulk, name)
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  registry = REGISTRY
+
+  def do_GET(self):
+    body = self.registry.render()
+    self.send_response(200)
+    self.send_header('Content-Type', CONTENT_TYPE)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def start_http_server(port, address=''):
+  """Serves the registry from a daemon thread, for processes without a
+  web server of their own."""
+  server = BaseHTTPServer.HTTPServer((address, port), MetricsRequestHandler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  logging.info("Serving metrics on port %d" % port)
+  return server
@@ -0,0 +1,124 @@
+import errno
+import logging
+import os
+import signal
+import sys
+import time
+
+
+class Supervisor(object):
+  """
+  Pre-forking process supervisor. Forks `num_processes` children that each
+  call `worker(*args)` and replaces every child that exits, whether it
+  crashed or retired itself after serving its share of requests.
+
+  Signals to the supervisor:
+    HUP       graceful recycle: start fresh workers, then ask the old ones
+              to finish their requests and exit. The new workers are forked
+              from the supervisor, so they run the code it loaded at
+              startup; deploying changed code needs a restart
+    TERM/INT  graceful shutdown of all workers, then exit
+
+  Workers are asked to stop with SIGTERM; they should stop accepting
+  connections and exit once in-flight requests are done.
+  """
+  # A worker that dies faster than this after starting counts as a failed
+  # start; repeated failed starts are throttled.
+  MIN_LIFETIME = 1.0
+
+  def __init__(self, num_processes, worker, *args):
+    self.num_processes = num_processes
+    self.worker = worker
+    self.args = args
+    self.children = {}
+    self.retired = set()
+    self.stopping = False
+    self.reload_requested = False
+
+  def spawn(self):
+    pid = os.fork()
+    if pid == 0:
+      signal.signal(signal.SIGHUP, signal.SIG_DFL)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      # Ctrl-C reaches the whole process group; let the supervisor turn it
+      # into a graceful shutdown.
+      signal.signal(signal.SIGINT, signal.SIG_IGN)
+      try:
+        self.worker(*self.args)
+      except Exception:
+        logging.exception("Worker %d failed" % os.getpid())
+        os._exit(1)
+      os._exit(0)
+    self.children[pid] = time.time()
+    logging.info("Started worker %d" % pid)
+    return pid
+
+  def on_reload(self, signum, frame):
+    self.reload_requested = True
+
+  def on_stop(self, signum, frame):
+    self.stopping = True
+
+  def reload(self):
+    self.reload_requested = False
+    old = list(self.children)
+    logging.info("Recycling %d workers" % len(old))
+    for pid in old:
+      # Start each replacement before retiring the old worker so capacity
+      # does not drop during the reload.
+      self.spawn()
+      self.kill(pid)
+      del self.children[pid]
+      self.retired.add(pid)
+
+  def kill(self, pid, sig=signal.SIGTERM):
+    try:
+      os.kill(pid, sig)
+    except OSError as e:
+      if e.errno != errno.ESRCH:
+        raise
+
+  def run(self):
+    signal.signal(signal.SIGHUP, self.on_reload)
+    signal.signal(signal.SIGTERM, self.on_stop)
+    signal.signal(signal.SIGINT, self.on_stop)
+    for i in range(self.num_processes):
+      self.spawn()
+
+    while self.children or self.retired:
+      if self.stopping:
+        for pid in list(self.children):
+          self.kill(pid)
+          self.retired.add(pid)
+        self.children.clear()
+      elif self.reload_requested:
+        self.reload()
+
+      try:
+        pid, status = os.wait()
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        if e.errno == errno.ECHILD:
+          break
+        raise
+
+      if pid in self.retired:
+        self.retired.discard(pid)
+        continue
+      started = self.children.pop(pid, None)
+      if started is None:
+        continue
+      if os.WIFSIGNALED(status):
+        logging.warning("Worker %d killed by signal %d" % (pid, os.WTERMSIG(status)))
+      elif os.WEXITSTATUS(status) != 0:
+        logging.warning("Worker %d exited with status %d" % (pid, os.WEXITSTATUS(status)))
+      else:
+        logging.info("Worker %d exited" % pid)
+      if not self.stopping:
+        if time.time() - started < self.MIN_LIFETIME:
+          time.sleep(self.MIN_LIFETIME)
+        self.spawn()
+
+    logging.info("All workers stopped")
+    sys.exit(0)
@@ -0,0 +1,97 @@
+import datetime
+import logging
+import time
+
+import pymongo
+import tornado.options
+from tornado.options import define, options
+
+import bulk
+import schema
+import util
+
+# How long a link check result stays fresh, by outcome.
+RECHECK_AGE = datetime.timedelta(days=30)
+ERROR_RECHECK_AGE = datetime.timedelta(days=1)
+# How long a queued recheck may take before the url is queued again.
+QUEUED_AGE = datetime.timedelta(days=1)
+
+
+def next_check(status, now=None):
+  """Returns when a url whose last check ended with `status` is due."""
+  now = now or datetime.datetime.now()
+  if status in (200, 304):
+    return now + RECHECK_AGE
+  return now + ERROR_RECHECK_AGE
+
+
+class Rechecker(object):
+  """
+  Periodically queues retrieval tasks for urls whose next_check date has
+  passed, oldest first. Failing links come due sooner and are queued
+  with a higher priority than healthy ones. Tasks carry the stored ETag and
+  Last-Modified values so most rechecks end in a 304 without a body.
+  """
+  def __init__(self, db, batch_size=1000):
+    self.db = db
+    self.batch_size = batch_size
+    self.db.urls.ensure_index('next_check')
+
+  def backfill(self):
+    """Makes urls never checked, or moved over without a next_check, due
+    immediately."""
+    self.db.urls.update({'next_check': {'$exists': False}},
+                             {'$set': {'next_check': datetime.datetime(1970, 1, 1)}},
+                             multi=True)
+
+  def queue_due(self):
+    """Queues one batch of due urls. Returns the number queued."""
+    now = datetime.datetime.now()
+    due = list(self.db.urls.find(
+        {'next_check': {'$lte': now}},
+        fields=['url', 'status', 'etag', 'last_modified'],
+        sort=[('next_check', pymongo.ASCENDING)],
+        limit=self.batch_size))
+    if not due:
+      return 0
+
+    tasks = self.db.tasks.initialize_unordered_bulk_op()
+    for entry in due:
+      if entry.get('status') in (200, 304):
+        priority = bulk.PRIORITY_RECHECK
+      else:
+        priority = bulk.PRIORITY_RECHECK_ERROR
+      task = bulk.make_task(entry, priority)
+      tasks.find({'canonical': task['canonical']}) \
+          .upsert().update_one({'$setOnInsert': task})
+    tasks.execute()
+
+    self.db.urls.update(
+      {'_id': {'$in': [e['_id'] for e in due]}},
+      {'$set': {'next_check': now + QUEUED_AGE}}, multi=True)
+    return len(due)
+
+  def run(self, interval):
+    logging.info("Rechecker started")
+    self.backfill()
+    while True:
+      queued = self.queue_due()
+      if queued:
+        logging.info("Queued %d urls for recheck" % queued)
+      if queued < self.batch_size:
+        time.sleep(interval)
+
+
+def main():
+  define("config_file", default="app_config.yml", help="app_config file")
+  define("interval", default=60, type=int,
+         help="seconds between scans once no urls are due")
+  define("batch_size", default=1000, type=int)
+  tornado.options.parse_command_line()
+  config = util.load_config(options.config_file)
+  db = schema.wrap(pymongo.Connection()[config.mongodb_database], config)
+  db.tasks.ensure_index('canonical')
+  Rechecker(db, options.batch_size).run(options.interval)
+
+if __name__ == '__main__':
+  main()
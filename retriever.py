@@ -1,7 +1,12 @@
-import sys
-import pycurl
+import collections
+import datetime
+import functools
 import logging
+import os
+import random
+import socket
 import time
+import urlparse
 
 # We should ignore SIGPIPE when using pycurl.NOSIGNAL - see
 # the libcurl tutorial for more info.
@@ -12,106 +17,414 @@ try:
 except ImportError:
   pass
 
-from cStringIO import StringIO
-
-import yaml
 import pymongo
-from pymongo.objectid import ObjectId
+from bson.objectid import ObjectId
 
-import tornado.web
+import tornado.ioloop
+import tornado.options
+import tornado.process
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from tornado.options import define, options
 define("config_file", default="app_config.yml", help="app_config file")
+define("concurrency", default=50, type=int,
+       help="maximum number of fetches in flight")
+define("per_host", default=2, type=int,
+       help="maximum number of fetches in flight per host")
+define("host_delay", default=1.0, type=float,
+       help="minimum seconds between two requests to the same host")
+define("lease_timeout", default=600, type=int,
+       help="seconds before a leased task is handed to another worker")
+define("max_attempts", default=5, type=int,
+       help="fetch attempts before a network error is recorded as final")
+define("workers", default=1, type=int,
+       help="number of worker processes to fork, 0 for one per cpu")
+define("shards", default=0, type=int,
+       help="total number of workers over all machines, defaults to --workers")
+define("shard_offset", default=0, type=int,
+       help="shard number of this machine's first worker")
+define("snapshots", default=True, type=bool,
+       help="keep a compressed snapshot of every fetched page")
+define("reuse_window", default=3600, type=int,
+       help="seconds a result fetched for one bookmark is copied to others "
+            "for the same canonical url instead of fetching it again")
+define("metrics_port", default=0, type=int,
+       help="serve metrics on this port, plus the worker number; 0 to disable")
+
+import metrics
+import recheck
+import schema
+import search
+import snapshots
+import urls
+import util
+
+# Idle polling backs off from MIN_IDLE to MAX_IDLE seconds while the task
+# queue is empty and resets as soon as a task is leased.
+MIN_IDLE = 0.05
+MAX_IDLE = 2.0
+# Leasing after a database error backs off from MIN_ERROR_DELAY to
+# MAX_ERROR_DELAY seconds.
+MIN_ERROR_DELAY = 1.0
+MAX_ERROR_DELAY = 60.0
+RETRY_BACKOFF = 30
+
+FETCHES = metrics.counter('retriever_fetches_total',
+                          'Finished fetches by response status class.',
+                          labels=('status',))
+FETCH_SECONDS = metrics.histogram('retriever_fetch_seconds',
+                                  'Fetch duration including redirects.',
+                                  buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+REUSED = metrics.counter('retriever_reused_total',
+                         'Tasks answered with the result of another fetch '
+                         'of the same page.', labels=('source',))
+LEASE_ERRORS = metrics.counter('retriever_lease_errors_total',
+                               'Database errors while leasing tasks.')
+RETRIES = metrics.counter('retriever_retries_total',
+                          'Network errors scheduled for another attempt.')
+STORE_ERRORS = metrics.counter('retriever_store_errors_total',
+                               'Fetch results that could not be stored.')
+
+
+def status_class(code):
+  if code == 599:
+    return 'network_error'
+  if code == 304:
+    return '304'
+  return '%dxx' % (code // 100)
 
 
 class Retriever(object):
-  def __init__(self):
-    self.conn = pymongo.Connection()
-    self.db = self.conn[self.config.mongodb_database]
-    num_conn = 10
-
-    # Initialize curl objects
-    curl = pycurl.CurlMulti()
-    curl.handles = []
-    for i in range(num_conn):
-      c = pycurl.Curl()
-      c.fp = None
-      c.setopt(pycurl.FOLLOWLOCATION, 1)
-      c.setopt(pycurl.MAXREDIRS, 5)
-      c.setopt(pycurl.CONNECTTIMEOUT, 30)
-      c.setopt(pycurl.TIMEOUT, 300)
-      c.setopt(pycurl.NOSIGNAL, 1)
-      curl.handles.append(c)
-    self.curl = curl
+  """
+  Fetches queued urls and records their status in the urls collection,
+  once per page however many bookmarks point to it.
+
+  Tasks are leased with find_and_modify and only removed once their result
+  is stored; a task whose worker dies becomes visible again after
+  `lease_timeout` seconds. Network errors are retried with exponential
+  backoff. Fetches run concurrently on the IOLoop, limited globally by
+  `concurrency` and per host by `per_host` and `host_delay`.
+
+  With `shards` > 1 the retriever only leases tasks whose partition falls
+  in its `shard`, so any number of retrievers can share the queue without
+  racing on tasks or on hosts.
+
+  Tasks are folded by canonical url: a task whose page is already being
+  fetched is dropped once that fetch is stored, and a task whose page was
+  fetched, directly or as a redirect target, within `reuse_window` seconds
+  is answered from the stored result without fetching.
+  """
+  def __init__(self, db=None, concurrency=None, per_host=None,
+               host_delay=None, lease_timeout=None, max_attempts=None,
+               shard=0, shards=1, reuse_window=None):
+    if db is None:
+      self.conn = pymongo.Connection()
+      db = self.conn[self.config.mongodb_database]
+      self.db = schema.wrap(metrics.InstrumentedDatabase(db), self.config)
+    else:
+      self.db = metrics.InstrumentedDatabase(db)
+    self.concurrency = concurrency or options.concurrency
+    self.per_host = per_host or options.per_host
+    self.host_delay = options.host_delay if host_delay is None else host_delay
+    self.lease_timeout = lease_timeout or options.lease_timeout
+    self.max_attempts = max_attempts or options.max_attempts
+    self.reuse_window = options.reuse_window if reuse_window is None else reuse_window
+    self.shard = shard
+    self.shards = shards
+    self.name = '%s:%d/%d' % (socket.gethostname(), os.getpid(), shard)
+    self.snapshots = snapshots.SnapshotStore(db) if options.snapshots else None
+
+    self.io_loop = tornado.ioloop.IOLoop.instance()
+    AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient',
+                              max_clients=self.concurrency)
+    self.http = AsyncHTTPClient(io_loop=self.io_loop)
+
+    self.active = 0
+    self.host_active = collections.defaultdict(int)
+    self.host_next = {}
+    self.waiting = collections.defaultdict(collections.deque)
+    self.num_waiting = 0
+    self.host_timeouts = {}
+    # Tasks waiting on an in-flight fetch of the same canonical url.
+    self.inflight = {}
+    self.num_folded = 0
+    self.fill_timeout = None
+    self.idle_delay = MIN_IDLE
+    self.error_delay = MIN_ERROR_DELAY
+    # Leases walk one of these in priority order, so no lease sorts in
+    # memory or scans the queue.
+    self.db.tasks.ensure_index([('priority', pymongo.DESCENDING),
+                                ('leased_until', pymongo.ASCENDING)])
+    self.db.tasks.ensure_index([('partition', pymongo.ASCENDING),
+                                ('priority', pymongo.DESCENDING),
+                                ('leased_until', pymongo.ASCENDING)])
+    self.partitions = None
+    if shards > 1:
+      self.partitions = [p for p in range(util.NUM_PARTITIONS) if p % shards == shard]
+      if shard == 0:
+        # Matches tasks queued before partitioning was introduced.
+        self.partitions.append(None)
+
+    metrics.callback('retriever_active_fetches', 'Fetches in flight.', 'gauge',
+                     lambda: self.active)
+    metrics.callback('retriever_waiting_tasks',
+                     'Leased tasks waiting for a busy host.', 'gauge',
+                     lambda: self.num_waiting)
+    metrics.callback('retriever_queue_depth', 'Tasks in the queue, all shards.',
+                     'gauge', lambda: db.tasks.count())
 
   @property
   def config(self):
     if not hasattr(self, '_config'):
-      logging.debug("Loading app config")
-      stream = file(options.config_file, 'r')
-      self._config = tornado.web._O(yaml.load(stream))
+      self._config = util.load_config(options.config_file)
     return self._config
 
   def run(self):
-    logging.info("Retriever started")
-    freelist = self.curl.handles[:]
-
-    while True:
-      queue = list(self.db.tasks.find(limit=20))
-
-      while queue and freelist:
-        task = queue.pop(0)
-        url = task['url']
-        user = task['user']
-        bookmark = task['bookmark']
-        self.db.tasks.remove(task['_id'])
-
-        c = freelist.pop()
-        c.fp = StringIO()
-        c.setopt(pycurl.URL, url.encode('utf8'))
-        c.setopt(pycurl.WRITEFUNCTION, c.fp.write)
-        self.curl.add_handle(c)
-        c.url = url
-        c.bookmark = bookmark
-        c.user = user
-
-        logging.info("Added %s to the queue" % c.url)
-
-      while 1:
-        ret, num_handles = self.curl.perform()
-        if ret != pycurl.E_CALL_MULTI_PERFORM:
-          break
-
-      while 1:
-        num_q, ok_list, err_list = self.curl.info_read()
-        for c in ok_list:
-          c.fp.close()
-          c.fp = None
-          self.curl.remove_handle(c)
-          # Update bookmark
-          dct = {'status': 200}
-          if c.getinfo(pycurl.EFFECTIVE_URL) != c.url:
-            dct['redirects'] = c.getinfo(pycurl.EFFECTIVE_URL)
-          self.db.bookmarks.update({'url_digest': c.bookmark, 'user': c.user},
-                                   {'$set': dct})
-          freelist.append(c)
-        for c, errno, errmsg in err_list:
-          c.fp.close()
-          c.fp = None
-          self.curl.remove_handle(c)
-          dct = {'status': errno, 'errormsg': errmsg}
-          self.db.bookmarks.update({'url_digest': c.bookmark, 'user': c.user},
-                                   {'$set': dct})
-          freelist.append(c)
-        if num_q == 0:
-          break
-
-      self.curl.select(1.0)
-      time.sleep(2)
+    logging.info("Retriever %s started" % self.name)
+    self.io_loop.add_callback(self.fill)
+    self.io_loop.start()
+
+  def lease(self):
+    now = datetime.datetime.now()
+    # Never leased tasks have no leased_until, which the index keeps as
+    # null, below any date.
+    query = {'leased_until': {'$not': {'$gt': now}}}
+    if self.partitions is not None:
+      # An $in on the index prefix merges the partitions in priority order.
+      query['partition'] = {'$in': self.partitions}
+    return self.db.tasks.find_and_modify(
+      query=query,
+      update={'$set': {'leased_until': now + datetime.timedelta(seconds=self.lease_timeout),
+                       'lease': ObjectId(), 'worker': self.name},
+              '$inc': {'attempts': 1}},
+      sort={'priority': pymongo.DESCENDING},
+      new=True)
+
+  def fill(self):
+    """Leases tasks until every fetch slot is busy or the queue is empty."""
+    self.fill_timeout = None
+    try:
+      # Keep some leased tasks waiting on busy hosts, but not without bound.
+      while self.active + self.num_waiting + self.num_folded < self.concurrency * 2:
+        task = self.lease()
+        self.error_delay = MIN_ERROR_DELAY
+        if task is None:
+          self.schedule_fill(self.idle_delay)
+          self.idle_delay = min(self.idle_delay * 2, MAX_IDLE)
+          return
+        self.idle_delay = MIN_IDLE
+        self.dispatch(task)
+    except Exception:
+      # Without a scheduled fill an idle retriever would never lease again.
+      logging.exception("Could not lease tasks, retrying in %.0fs" % self.error_delay)
+      LEASE_ERRORS.inc()
+      self.schedule_fill(self.error_delay)
+      self.error_delay = min(self.error_delay * 2, MAX_ERROR_DELAY)
+
+  def schedule_fill(self, delay):
+    if self.fill_timeout is not None:
+      self.io_loop.remove_timeout(self.fill_timeout)
+    self.fill_timeout = self.io_loop.add_timeout(time.time() + delay, self.fill)
+
+  def dispatch(self, task):
+    canonical = task.get('canonical') or util.canonical_digest(task['url'])
+    task['canonical'] = canonical
+    if canonical in self.inflight:
+      self.inflight[canonical].append(task)
+      self.num_folded += 1
+      return
+    if self.reuse(task):
+      return
+    self.inflight[canonical] = []
+    host = (urlparse.urlsplit(task['url']).hostname or '').lower()
+    self.waiting[host].append(task)
+    self.num_waiting += 1
+    self.release_host(host)
+
+  def reuse(self, task):
+    """Answers the task from a recent result for its page, or for a page
+    redirecting to it, if there is one. Returns whether it did."""
+    if not self.reuse_window:
+      return False
+    since = datetime.datetime.now() - datetime.timedelta(seconds=self.reuse_window)
+    canonical = task['canonical']
+    source = self.db.urls.find_one(
+      {'$or': [{'_id': canonical, 'checked': {'$gte': since}},
+               {'redirect_digest': canonical, 'checked': {'$gte': since}}],
+       'status': {'$ne': 599}})
+    if source is None:
+      return False
+    if source['_id'] != canonical:
+      # The result of the redirect target, without the redirect.
+      result = dict((k, source[k]) for k in urls.FIELDS if k in source)
+      for key in ('redirects', 'redirect_digest'):
+        result.pop(key, None)
+      self.store(task, {'$set': result,
+                        '$unset': {'redirects': 1, 'redirect_digest': 1}})
+    else:
+      self.db.tasks.remove({'_id': task['_id'], 'lease': task['lease']})
+    REUSED.inc(source='stored')
+    return True
+
+  def host_ready(self, host):
+    return (self.host_active.get(host, 0) < self.per_host and
+            self.host_next.get(host, 0) <= time.time())
+
+  def release_host(self, host):
+    """Starts waiting fetches for `host` as far as its limits allow."""
+    timeout = self.host_timeouts.pop(host, None)
+    if timeout is not None:
+      self.io_loop.remove_timeout(timeout)
+    queue = self.waiting.get(host)
+    while queue and self.active < self.concurrency and self.host_ready(host):
+      self.num_waiting -= 1
+      self.start(queue.popleft(), host)
+    if not queue:
+      self.waiting.pop(host, None)
+      if host not in self.host_active and self.host_next.get(host, 0) <= time.time():
+        self.host_next.pop(host, None)
+    elif (self.host_active.get(host, 0) < self.per_host and
+          host not in self.host_timeouts):
+      # Only the rate limit holds this host back; connection limits are
+      # released by on_response.
+      deadline = max(self.host_next.get(host, 0), time.time())
+      self.host_timeouts[host] = self.io_loop.add_timeout(
+        deadline, functools.partial(self.release_host, host))
+
+  def start(self, task, host):
+    self.active += 1
+    self.host_active[host] += 1
+    self.host_next[host] = time.time() + self.host_delay
+    headers = {}
+    if task.get('etag'):
+      headers['If-None-Match'] = task['etag']
+    if task.get('last_modified'):
+      headers['If-Modified-Since'] = task['last_modified']
+    if self.snapshots is not None:
+      writer = snapshots.SnapshotWriter()
+      streaming_callback, header_callback = writer.write, writer.header
+    else:
+      writer = None
+      streaming_callback, header_callback = lambda chunk: None, None
+    request = HTTPRequest(task['url'].encode('utf8'),
+                          headers=headers,
+                          follow_redirects=True,
+                          max_redirects=5,
+                          connect_timeout=30,
+                          request_timeout=300,
+                          streaming_callback=streaming_callback,
+                          header_callback=header_callback)
+    logging.debug("Fetching %s" % task['url'])
+    self.http.fetch(request,
+                    functools.partial(self.on_response, task, host, writer))
+
+  def on_response(self, task, host, writer, response):
+    self.active -= 1
+    self.host_active[host] -= 1
+    if not self.host_active[host]:
+      del self.host_active[host]
+    FETCHES.inc(status=status_class(response.code))
+    FETCH_SECONDS.observe(response.request_time)
+
+    followers = self.inflight.pop(task['canonical'], [])
+    self.num_folded -= len(followers)
+    try:
+      if response.code == 599 and task.get('attempts', 1) < self.max_attempts:
+        self.retry(task, response)
+      else:
+        self.store(task, self.result(task, response, writer))
+      # Duplicate tasks for the page are covered by this one.
+      for follower in followers:
+        self.db.tasks.remove({'_id': follower['_id'], 'lease': follower['lease']})
+        REUSED.inc(source='inflight')
+    except Exception:
+      logging.exception("Could not store result for %s" % task['url'])
+      STORE_ERRORS.inc()
+    finally:
+      if writer is not None:
+        writer.discard()
+
+    for waiting_host in [host] + self.waiting.keys():
+      if self.active >= self.concurrency:
+        break
+      self.release_host(waiting_host)
+    self.fill()
+
+  def result(self, task, response, writer=None):
+    """Returns the urls update recording `response`."""
+    now = datetime.datetime.now()
+    dct = {'checked': now, 'next_check': recheck.next_check(response.code, now)}
+    unset = {}
+    if response.code == 304:
+      # Unchanged since the last fetch; the stored status and validators
+      # are still current.
+      dct['status'] = 200
+      unset['errormsg'] = 1
+    else:
+      dct['status'] = response.code
+      if response.error:
+        dct['errormsg'] = str(response.error)
+      else:
+        unset['errormsg'] = 1
+      for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+        value = response.headers.get(header) if response.code == 200 else None
+        if value:
+          dct[key] = value
+        else:
+          unset[key] = 1
+      if response.effective_url and response.effective_url != task['url']:
+        dct['redirects'] = response.effective_url
+      redirect_digest = util.canonical_digest(response.effective_url or task['url'])
+      if redirect_digest != task['canonical']:
+        # Lets tasks for the redirect target reuse this fetch.
+        dct['redirect_digest'] = redirect_digest
+      else:
+        unset['redirect_digest'] = 1
+      if writer is not None and response.code == 200:
+        dct['snapshot'] = self.snapshots.put(
+          writer, response.headers.get('Content-Type'))
+        dct['text'] = search.excerpt(writer.text)
+    update = {'$set': dct}
+    if unset:
+      update['$unset'] = unset
+    return update
+
+  def store(self, task, update):
+    update = dict(update, **{'$setOnInsert': {'url': task['url']}})
+    old = self.db.urls.find_and_modify(
+      {'_id': task['canonical']}, update, upsert=True, fields=['text'])
+    text = update['$set'].get('text')
+    if text is not None and (old is None or old.get('text') != text):
+      # The text index is on bookmarks, so each one keeps a copy of the
+      # excerpt; a refetch of an unchanged page writes none of them.
+      self.db.bookmarks.update({'canonical_digest': task['canonical']},
+                               {'$set': {'text': text}}, multi=True)
+    self.db.tasks.remove({'_id': task['_id'], 'lease': task['lease']})
+
+  def retry(self, task, response):
+    delay = RETRY_BACKOFF * 2 ** (task.get('attempts', 1) - 1)
+    delay = random.uniform(delay / 2.0, delay)
+    RETRIES.inc()
+    logging.info("Retrying %s in %ds: %s" % (task['url'], delay, response.error))
+    self.db.tasks.update(
+      {'_id': task['_id'], 'lease': task['lease']},
+      {'$set': {'leased_until': datetime.datetime.now() +
+                                datetime.timedelta(seconds=delay)}})
 
 
 def main():
   tornado.options.parse_command_line()
-  retriever = Retriever()
+  workers = options.workers or tornado.process.cpu_count()
+  shards = options.shards or workers
+  if options.shard_offset + workers > shards:
+    raise ValueError("--shard_offset + --workers must not exceed --shards")
+  task_id = 0
+  if workers > 1:
+    # Forks the workers and restarts any that die. Each worker opens its
+    # own mongo connection and IOLoop after the fork.
+    task_id = tornado.process.fork_processes(workers)
+  if options.metrics_port:
+    metrics.start_http_server(options.metrics_port + task_id)
+  retriever = Retriever(shard=options.shard_offset + task_id, shards=shards)
   retriever.run()
 
 if __name__ == '__main__':
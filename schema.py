@@ -0,0 +1,345 @@
+"""
+Compact storage format for bookmark documents.
+
+With `compact_schema: True` in the config, bookmark fields are stored under
+the one or two letter keys in FIELDS and url digests as 16 byte binaries
+instead of 32 character hex strings. The mapping lives entirely in
+CompactDatabase: queries, updates, projections, sorts and index specs are
+translated on the way in and documents on the way out, so the rest of the
+code keeps using the long names and hex digests. Keys that are not in
+FIELDS, such as text search scores, pass through unchanged.
+
+Existing collections are converted, or converted back, with
+
+  python schema.py --config_file=app_config.yml
+  python schema.py --config_file=app_config.yml --expand
+
+while nothing else writes to the database. The migration drops the
+bookmark indexes; they are rebuilt on the new keys when app.py starts.
+"""
+import binascii
+import logging
+
+import pymongo
+import tornado.options
+from bson.binary import Binary
+from tornado.options import define, options
+
+import util
+
+FIELDS = {
+  'user': 'u',
+  'url': 'l',
+  'url_digest': 'd',
+  'canonical_digest': 'cd',
+  'redirect_digest': 'rd',
+  'title': 't',
+  'description': 'n',
+  'tags': 'g',
+  'modified': 'm',
+  'status': 's',
+  'errormsg': 'e',
+  'checked': 'c',
+  'next_check': 'k',
+  'etag': 'et',
+  'last_modified': 'lm',
+  'redirects': 'r',
+  'snapshot': 'p',
+  'text': 'x',
+}
+LONG_FIELDS = dict((short, long) for long, short in FIELDS.iteritems())
+DIGEST_FIELDS = frozenset(['url_digest', 'canonical_digest', 'redirect_digest'])
+
+# Collections stored in the compact format.
+COLLECTIONS = frozenset(['bookmarks'])
+
+
+def wrap(db, config):
+  """Returns `db`, wrapped in a CompactDatabase if the config asks for it."""
+  if config.get('compact_schema', False):
+    return CompactDatabase(db)
+  return db
+
+
+def compact_key(key):
+  head, dot, rest = key.partition('.')
+  return FIELDS.get(head, head) + dot + rest
+
+
+def compact_digest(value):
+  if isinstance(value, basestring) and len(value) == 32:
+    return Binary(binascii.unhexlify(value))
+  return value
+
+
+def expand_digest(value):
+  # Binary is a str subclass; hex digests come back from BSON as unicode.
+  if isinstance(value, str):
+    return binascii.hexlify(value)
+  return value
+
+
+def compact_value(key, value):
+  if key not in DIGEST_FIELDS:
+    return value
+  if isinstance(value, dict):
+    return dict((op, [compact_digest(v) for v in operand]
+                     if isinstance(operand, (list, tuple))
+                     else compact_digest(operand))
+                for op, operand in value.iteritems())
+  return compact_digest(value)
+
+
+def compact_query(spec):
+  if not isinstance(spec, dict):
+    return spec
+  result = {}
+  for key, value in spec.iteritems():
+    if key in ('$or', '$and', '$nor'):
+      value = [compact_query(clause) for clause in value]
+    elif not key.startswith('$'):
+      value = compact_value(key, value)
+      key = compact_key(key)
+    result[key] = value
+  return result
+
+
+def compact_document(document):
+  return dict((compact_key(k), compact_value(k, v)) for k, v in document.iteritems())
+
+
+def expand_document(document):
+  if document is None:
+    return None
+  result = {}
+  for key, value in document.iteritems():
+    key = LONG_FIELDS.get(key, key)
+    if key in DIGEST_FIELDS:
+      value = expand_digest(value)
+    result[key] = value
+  return result
+
+
+def compact_update(document):
+  if not any(key.startswith('$') for key in document):
+    return compact_document(document)
+  result = {}
+  for op, fields in document.iteritems():
+    if op == '$rename':
+      fields = dict((compact_key(k), compact_key(v)) for k, v in fields.iteritems())
+    elif op in ('$set', '$setOnInsert'):
+      fields = compact_document(fields)
+    else:
+      fields = dict((compact_key(k), v) for k, v in fields.iteritems())
+    result[op] = fields
+  return result
+
+
+def compact_fields(fields):
+  """Translates a projection, a sort or an index spec."""
+  if fields is None:
+    return None
+  if isinstance(fields, basestring):
+    return compact_key(fields)
+  if isinstance(fields, dict):
+    return dict((compact_key(k), v) for k, v in fields.iteritems())
+  return [(compact_key(f[0]),) + tuple(f[1:]) if isinstance(f, tuple)
+          else compact_key(f) for f in fields]
+
+
+class CompactDatabase(object):
+  """Wraps a Database, or an InstrumentedDatabase, so the collections in
+  COLLECTIONS use the compact format."""
+  def __init__(self, database):
+    self.database = database
+
+  def __getattr__(self, name):
+    if name in COLLECTIONS:
+      return CompactCollection(self.database[name])
+    return getattr(self.database, name)
+
+  def __getitem__(self, name):
+    if name in COLLECTIONS:
+      return CompactCollection(self.database[name])
+    return self.database[name]
+
+
+class CompactCollection(object):
+  def __init__(self, collection):
+    self.collection = collection
+
+  def __getattr__(self, name):
+    return getattr(self.collection, name)
+
+  def find(self, spec=None, fields=None, *args, **kwargs):
+    if kwargs.get('sort'):
+      kwargs['sort'] = compact_fields(kwargs['sort'])
+    return CompactCursor(self.collection.find(
+      compact_query(spec), compact_fields(fields), *args, **kwargs))
+
+  def find_one(self, spec_or_id=None, *args, **kwargs):
+    if spec_or_id is not None and not isinstance(spec_or_id, dict):
+      spec_or_id = {'_id': spec_or_id}
+    for document in self.find(spec_or_id, *args, **kwargs).limit(-1):
+      return document
+    return None
+
+  def find_and_modify(self, query=None, update=None, *args, **kwargs):
+    for name in ('sort', 'fields'):
+      if kwargs.get(name):
+        kwargs[name] = compact_fields(kwargs[name])
+    return expand_document(self.collection.find_and_modify(
+      compact_query(query or {}), update and compact_update(update),
+      *args, **kwargs))
+
+  def update(self, spec, document, *args, **kwargs):
+    return self.collection.update(compact_query(spec), compact_update(document),
+                                  *args, **kwargs)
+
+  def remove(self, spec_or_id=None, *args, **kwargs):
+    return self.collection.remove(compact_query(spec_or_id), *args, **kwargs)
+
+  def insert(self, doc_or_docs, *args, **kwargs):
+    if isinstance(doc_or_docs, dict):
+      documents = [doc_or_docs]
+    else:
+      documents = list(doc_or_docs)
+    compacted = [compact_document(d) for d in documents]
+    ids = self.collection.insert(compacted, *args, **kwargs)
+    # pymongo sets _id on the documents it inserts; callers expect it on
+    # theirs.
+    for document, stored in zip(documents, compacted):
+      document['_id'] = stored['_id']
+    return ids[0] if isinstance(doc_or_docs, dict) else ids
+
+  def save(self, document, *args, **kwargs):
+    compacted = compact_document(document)
+    result = self.collection.save(compacted, *args, **kwargs)
+    document['_id'] = compacted['_id']
+    return result
+
+  def ensure_index(self, key_or_list, *args, **kwargs):
+    if 'weights' in kwargs:
+      kwargs['weights'] = compact_fields(kwargs['weights'])
+    return self.collection.ensure_index(compact_fields(key_or_list), *args, **kwargs)
+
+  def drop_index(self, index_or_name):
+    if not isinstance(index_or_name, basestring):
+      index_or_name = compact_fields(index_or_name)
+    return self.collection.drop_index(index_or_name)
+
+  def initialize_ordered_bulk_op(self):
+    return CompactBulk(self.collection.initialize_ordered_bulk_op())
+
+  def initialize_unordered_bulk_op(self):
+    return CompactBulk(self.collection.initialize_unordered_bulk_op())
+
+
+class CompactCursor(object):
+  def __init__(self, cursor):
+    self.cursor = cursor
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    return expand_document(self.cursor.next())
+
+  def sort(self, key_or_list, direction=None):
+    if direction is None:
+      self.cursor.sort(compact_fields(key_or_list))
+    else:
+      self.cursor.sort(compact_key(key_or_list), direction)
+    return self
+
+  def __getattr__(self, name):
+    attr = getattr(self.cursor, name)
+    if not callable(attr):
+      return attr
+
+    def call(*args, **kwargs):
+      result = attr(*args, **kwargs)
+      return self if result is self.cursor else result
+    return call
+
+
+class CompactBulk(object):
+  def __init__(self, bulk):
+    self.bulk = bulk
+
+  def find(self, selector):
+    return CompactBulkSelector(self.bulk.find(compact_query(selector)))
+
+  def insert(self, document):
+    self.bulk.insert(compact_document(document))
+
+  def execute(self, *args, **kwargs):
+    return self.bulk.execute(*args, **kwargs)
+
+
+class CompactBulkSelector(object):
+  def __init__(self, selector):
+    self.selector = selector
+
+  def upsert(self):
+    return CompactBulkSelector(self.selector.upsert())
+
+  def update(self, document):
+    self.selector.update(compact_update(document))
+
+  def update_one(self, document):
+    self.selector.update_one(compact_update(document))
+
+  def replace_one(self, document):
+    self.selector.replace_one(compact_document(document))
+
+  def remove(self):
+    self.selector.remove()
+
+  def remove_one(self):
+    self.selector.remove_one()
+
+
+def migrate(db, name, expand=False, batch_size=1000):
+  """Rewrites every document of a collection in the compact format, or back
+  with `expand`. Documents already in the target format are skipped, so an
+  interrupted migration can be run again. Returns the number rewritten."""
+  collection = db[name]
+  if expand:
+    convert, pending = expand_document, {FIELDS['user']: {'$exists': True}}
+  else:
+    convert, pending = compact_document, {'user': {'$exists': True}}
+  migrated = 0
+  batch = collection.initialize_unordered_bulk_op()
+  size = 0
+  for document in collection.find(pending, snapshot=True):
+    # The format check in the selector makes a document seen twice a no-op.
+    batch.find(dict(pending, _id=document['_id'])).replace_one(convert(document))
+    size += 1
+    if size == batch_size:
+      batch.execute()
+      migrated += size
+      logging.info("Migrated %d %s" % (migrated, name))
+      batch, size = collection.initialize_unordered_bulk_op(), 0
+  if size:
+    batch.execute()
+    migrated += size
+  collection.drop_indexes()
+  return migrated
+
+
+def main():
+  define("config_file", default="app_config.yml", help="app_config file")
+  define("expand", default=False, type=bool,
+         help="convert back from the compact format")
+  define("batch_size", default=1000, type=int)
+  tornado.options.parse_command_line()
+  config = util.load_config(options.config_file)
+  db = pymongo.Connection()[config.mongodb_database]
+  for name in sorted(COLLECTIONS):
+    migrated = migrate(db, name, options.expand, options.batch_size)
+    logging.info("Migrated %d %s; set compact_schema: %s and restart app.py "
+                 "to rebuild the indexes" % (migrated, name, not options.expand))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,112 @@
+import collections
+import re
+
+import pymongo
+
+# Bookmarks are searched through a MongoDB text index over these fields.
+# MongoDB keeps the index current on every insert, update and delete.
+WEIGHTS = {'title': 10, 'tags': 5, 'description': 2, 'text': 1}
+# Bookmarks keep the first MAX_EXCERPT characters of their page's text for
+# the index, so words further into a page are not found. The whole text is
+# kept once, with the page's snapshot.
+MAX_EXCERPT = 16 * 1024
+# Fields whose words go into the per-user vocabulary used to expand prefixes.
+VOCABULARY_FIELDS = ('title', 'description', 'tags')
+MAX_EXPANSIONS = 10
+MAX_TERM_LENGTH = 40
+
+
+def ensure_indexes(db):
+  db.bookmarks.ensure_index(
+    [('user', pymongo.ASCENDING)] + [(f, pymongo.TEXT) for f in sorted(WEIGHTS)],
+    weights=WEIGHTS, default_language='none', name='search', background=True)
+  db.search_terms.ensure_index([('user', pymongo.ASCENDING),
+                                ('term', pymongo.ASCENDING)], unique=True)
+
+
+def excerpt(text):
+  """Returns the start of a page's text, cut at a word boundary."""
+  if len(text) <= MAX_EXCERPT:
+    return text
+  return text[:MAX_EXCERPT].rsplit(None, 1)[0]
+
+
+def tokenize(text):
+  return [t for t in re.findall(r'\w+', text.lower(), re.UNICODE)
+          if 1 < len(t) <= MAX_TERM_LENGTH]
+
+
+def bookmark_terms(bookmark):
+  terms = set()
+  for field in VOCABULARY_FIELDS:
+    value = bookmark.get(field)
+    if not value:
+      continue
+    if isinstance(value, list):
+      value = u' '.join(value)
+    terms.update(tokenize(value))
+  return terms
+
+
+def change_terms(db, user_id, removed=(), added=()):
+  """
+  Keeps the user's vocabulary counting, for each word, the bookmarks it
+  appears in: `removed` are bookmarks, or their old versions, whose words
+  no longer count and `added` ones whose words now do. One bulk write;
+  words no bookmark has left are deleted.
+  """
+  count = collections.defaultdict(int)
+  for bookmark in removed:
+    for term in bookmark_terms(bookmark):
+      count[term] -= 1
+  for bookmark in added:
+    for term in bookmark_terms(bookmark):
+      count[term] += 1
+  count = dict((term, value) for term, value in count.iteritems() if value)
+  if not count:
+    return
+  bulk = db.search_terms.initialize_unordered_bulk_op()
+  for term, value in count.iteritems():
+    bulk.find({'user': user_id, 'term': term}).upsert() \
+        .update_one({'$inc': {'count': value}})
+  bulk.execute()
+  dropped = [term for term, value in count.iteritems() if value < 0]
+  if dropped:
+    db.search_terms.remove({'user': user_id, 'term': {'$in': dropped},
+                            'count': {'$lte': 0}})
+
+
+def add_terms(db, user_id, bookmarks):
+  change_terms(db, user_id, added=bookmarks)
+
+
+def remove_terms(db, user_id, bookmarks):
+  change_terms(db, user_id, removed=bookmarks)
+
+
+def expand(db, user_id, prefix):
+  """Returns the user's most frequent words starting with `prefix`."""
+  return [t['term'] for t in db.search_terms.find(
+    {'user': user_id, 'term': {'$regex': '^' + re.escape(prefix)},
+     'count': {'$gt': 0}},
+    fields=['term'], sort=[('count', pymongo.DESCENDING)],
+    limit=MAX_EXPANSIONS)]
+
+
+def search(db, user_id, query, limit=25, skip=0, fields=None):
+  """
+  Returns the user's bookmarks matching `query`, best matches first. Unless
+  the query ends in a space its last word is also matched as a prefix.
+  """
+  terms = tokenize(query)
+  if not terms:
+    return []
+  if not query[-1].isspace():
+    terms.extend(expand(db, user_id, terms[-1]))
+  projection = dict((f, 1) for f in fields or ('url', 'title', 'canonical_digest'))
+  projection['score'] = {'$meta': 'textScore'}
+  cursor = db.bookmarks.find(
+      {'user': user_id, '$text': {'$search': u' '.join(set(terms))}},
+      projection)
+  cursor.sort([('score', {'$meta': 'textScore'})]).skip(skip).limit(limit)
+  return list(cursor)
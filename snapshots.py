@@ -0,0 +1,134 @@
+import hashlib
+import re
+import tempfile
+import zlib
+
+import gridfs
+from bson.binary import Binary
+from lxml import etree
+
+# Bodies are cut off at this many bytes and their text at this many characters.
+MAX_SIZE = 2 * 1024 * 1024
+MAX_TEXT = 64 * 1024
+
+SKIPPED_TAGS = frozenset(['script', 'style', 'noscript', 'head', 'title'])
+
+
+class TextExtractor(object):
+  """lxml parser target that collects the visible text of a page."""
+
+  def __init__(self, max_text=MAX_TEXT):
+    self.max_text = max_text
+    self.chunks = []
+    self.length = 0
+    self.skipping = 0
+
+  def start(self, tag, attrib):
+    if tag in SKIPPED_TAGS:
+      self.skipping += 1
+
+  def end(self, tag):
+    if tag in SKIPPED_TAGS and self.skipping:
+      self.skipping -= 1
+
+  def data(self, data):
+    if self.skipping or self.length >= self.max_text:
+      return
+    data = data[:self.max_text - self.length]
+    self.chunks.append(data)
+    self.length += len(data)
+
+  def close(self):
+    return re.sub(r'\s+', u' ', u' '.join(self.chunks)).strip()
+
+
+class SnapshotWriter(object):
+  """
+  Receives a page body chunk by chunk, as a streaming_callback, and keeps a
+  zlib compressed copy of it in a temporary file together with its sha1.
+  The visible text of html pages is extracted into `text` on close. Nothing
+  but the current chunk is held in memory. Bodies larger than `max_size`
+  are truncated.
+  """
+  def __init__(self, max_size=MAX_SIZE, max_text=MAX_TEXT):
+    self.max_size = max_size
+    self.size = 0
+    self.truncated = False
+    self.html = True
+    self.sha1 = hashlib.sha1()
+    self.compressor = zlib.compressobj()
+    self.file = tempfile.TemporaryFile()
+    self.text = u''
+    self.parser = etree.HTMLParser(target=TextExtractor(max_text))
+
+  def header(self, line):
+    """header_callback; turns text extraction off for non-html bodies."""
+    name, _, value = line.partition(':')
+    if name.strip().lower() == 'content-type':
+      self.html = 'html' in value.lower()
+
+  def write(self, chunk):
+    if self.truncated:
+      return
+    if self.size + len(chunk) > self.max_size:
+      chunk = chunk[:self.max_size - self.size]
+      self.truncated = True
+    self.size += len(chunk)
+    self.sha1.update(chunk)
+    self.file.write(self.compressor.compress(chunk))
+    if self.html:
+      self.parser.feed(chunk)
+
+  def close(self):
+    """Returns the content hash. The compressed body can then be read from
+    the start of `file`."""
+    self.file.write(self.compressor.flush())
+    self.file.seek(0)
+    if self.html and self.size:
+      try:
+        self.text = self.parser.close()
+      except etree.LxmlError:
+        pass
+    return self.sha1.hexdigest()
+
+  def discard(self):
+    self.file.close()
+
+
+class SnapshotStore(object):
+  """
+  Content addressed page snapshots in GridFS. A snapshot's id is the sha1
+  of the page body, so a page saved by many users is stored once. Bodies
+  are stored zlib compressed; the extracted text is kept, compressed, on the
+  GridFS file document.
+  """
+  def __init__(self, db):
+    self.fs = gridfs.GridFS(db, 'snapshots')
+
+  def put(self, writer, content_type=None):
+    """Stores a closed SnapshotWriter unless its content is already stored.
+    Returns the snapshot id."""
+    key = writer.close()
+    try:
+      if not self.fs.exists(key):
+        self.fs.put(writer.file, _id=key,
+                    compression='zlib',
+                    length_uncompressed=writer.size,
+                    truncated=writer.truncated,
+                    content_type=content_type,
+                    text=Binary(zlib.compress(writer.text.encode('utf8'))))
+    finally:
+      writer.discard()
+    return key
+
+  def open(self, key):
+    """Yields the decompressed body of a snapshot in chunks."""
+    decompressor = zlib.decompressobj()
+    f = self.fs.get(key)
+    for chunk in iter(lambda: f.read(64 * 1024), ''):
+      yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+  def text(self, key):
+    f = self.fs.get(key)
+    return zlib.decompress(f.text).decode('utf8')
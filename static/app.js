@@ -5,3 +5,101 @@ $(".dropdown-toggle, .menu").click(function (e) {
   var $li = $(this).parent("li").toggleClass('open');
   return false;
 });
+
+// Infinite scroll for the bookmark listing. The "More" link keeps working
+// as a plain link when javascript is off.
+(function () {
+  var more = $('#more-bookmarks');
+  if (!more.length) {
+    return;
+  }
+  var loading = false;
+
+  // Mirrors the rows of templates/home.html.
+  function row(bookmark) {
+    var tr = $('<tr class="bookmark"><td></td><td></td></tr>');
+    var cells = tr.find('td');
+    var status = bookmark.status === null || bookmark.status === undefined ? '' : bookmark.status;
+    $('<input type="checkbox" name="bookmark">').val(bookmark.id).appendTo(cells.eq(0));
+    cells.eq(0).append(document.createTextNode(' ' + status + ' '));
+    $('<a>').attr('href', bookmark.url).text(bookmark.title || '').appendTo(cells.eq(0));
+    $('<a>').attr('href', bookmark.edit_url).text('Edit').appendTo(cells.eq(1));
+    if (bookmark.cache_url) {
+      cells.eq(1).append(document.createTextNode(' '));
+      $('<a>').attr('href', bookmark.cache_url).text('Cached').appendTo(cells.eq(1));
+    }
+    return tr;
+  }
+
+  function load() {
+    if (loading || !more.data('cursor')) {
+      return;
+    }
+    loading = true;
+    var params = {cursor: more.data('cursor')};
+    if (more.data('tag')) {
+      params.tag = more.data('tag');
+    }
+    $.getJSON(more.data('source'), params, function (data) {
+      var tbody = $('#bookmarks tbody');
+      $.each(data.bookmarks, function (i, bookmark) {
+        tbody.append(row(bookmark));
+      });
+      more.data('cursor', data.next);
+      if (!data.next) {
+        more.remove();
+      }
+      loading = false;
+    });
+  }
+
+  more.click(function (e) {
+    e.preventDefault();
+    load();
+  });
+  $(window).scroll(function () {
+    if ($(window).scrollTop() + $(window).height() > $(document).height() - 200) {
+      load();
+    }
+  });
+})();
+
+// Tag completion for the comma separated tags field of the bookmark forms.
+(function () {
+  var input = $('form.bookmark input[name=tags]');
+  if (!input.length) {
+    return;
+  }
+  var list = $('<ul class="tag-suggestions unstyled"></ul>').hide().insertAfter(input);
+  var timer = null;
+
+  function replaceLast(tag) {
+    var parts = input.val().split(',');
+    parts[parts.length - 1] = ' ' + tag;
+    input.val($.trim(parts.join(',')) + ', ').focus();
+    list.hide();
+  }
+
+  function suggest() {
+    $.getJSON('/tags/complete', {q: input.val()}, function (data) {
+      list.empty();
+      $.each(data.tags, function (i, tag) {
+        $('<li><a href="#"></a></li>').find('a').text(tag.name + ' (' + tag.count + ')')
+          .click(function (e) {
+            e.preventDefault();
+            replaceLast(tag.name);
+          }).end().appendTo(list);
+      });
+      list.toggle(data.tags.length > 0);
+    });
+  }
+
+  input.attr('autocomplete', 'off').keyup(function (e) {
+    if (e.which === 27) {
+      list.hide();
+      return;
+    }
+    clearTimeout(timer);
+    timer = setTimeout(suggest, 100);
+  });
+})();
@@ -0,0 +1,150 @@
+import collections
+import logging
+
+import pymongo
+from bson.objectid import ObjectId
+import tornado.options
+from tornado.options import define, options
+
+import schema
+import util
+
+
+# Co-occurrence is tracked among at most this many tags of a bookmark, which
+# bounds the pair writes a heavily tagged bookmark costs.
+MAX_PAIR_TAGS = 20
+
+# Called as listener(user_id, delta) after apply_delta has written a delta,
+# from whichever thread wrote it.
+listeners = []
+
+
+def pairs(tags):
+  """Returns the ordered (tag, other) pairs of a bookmark's tags."""
+  tags = sorted(set(tags or ()))[:MAX_PAIR_TAGS]
+  return [(tag, other) for tag in tags for other in tags if tag != other]
+
+
+def diff(old_tags, new_tags):
+  """
+  Returns the count deltas for a bookmark going from old to new tags. Keys
+  are tag names for the tag counts and (tag, other) tuples for the
+  co-occurrence counts, which are kept in both directions.
+  """
+  delta = collections.defaultdict(int)
+  for tag in set(old_tags or ()):
+    delta[tag] -= 1
+  for tag in set(new_tags or ()):
+    delta[tag] += 1
+  for pair in pairs(old_tags):
+    delta[pair] -= 1
+  for pair in pairs(new_tags):
+    delta[pair] += 1
+  return dict((key, count) for key, count in delta.iteritems() if count)
+
+
+def accumulate(delta, old_tags, new_tags):
+  """Adds the diff of one bookmark to a defaultdict(int) of deltas."""
+  for key, count in diff(old_tags, new_tags).iteritems():
+    delta[key] += count
+
+
+def apply_delta(db, user_id, delta):
+  """
+  Applies deltas from diff to the user's tags and tag_pairs counters, with
+  one bulk write per collection.
+  """
+  tags = db.tags.initialize_unordered_bulk_op()
+  tag_pairs = db.tag_pairs.initialize_unordered_bulk_op()
+  writes = collections.defaultdict(int)
+  removed = set()
+  for key, count in delta.iteritems():
+    if not count:
+      continue
+    if isinstance(key, tuple):
+      tag_pairs.find({'user': user_id, 'tag': key[0], 'other': key[1]}) \
+          .upsert().update_one({'$inc': {'count': count}})
+      collection = 'tag_pairs'
+    else:
+      tags.find({'user': user_id, 'name': key}).upsert() \
+          .update_one({'$inc': {'count': count}})
+      collection = 'tags'
+    writes[collection] += 1
+    if count < 0:
+      removed.add(collection)
+  if writes['tags']:
+    tags.execute()
+  if writes['tag_pairs']:
+    tag_pairs.execute()
+  for collection in removed:
+    db[collection].remove({'user': user_id, 'count': {'$lte': 0}})
+  for listener in listeners:
+    listener(user_id, delta)
+
+
+def update(db, user_id, old_tags, new_tags):
+  apply_delta(db, user_id, diff(old_tags, new_tags))
+
+
+def reconcile(db, user_id):
+  """Recounts the user's tags and tag pairs from scratch. Used for offline
+  repair, and to build the pair counts for existing bookmarks."""
+  count = collections.defaultdict(int)
+  for bookmark in db.bookmarks.find({'user': user_id}, fields=['tags']):
+    accumulate(count, None, bookmark.get('tags'))
+  names = [key for key in count if not isinstance(key, tuple)]
+  for name in names:
+    db.tags.update({'user': user_id, 'name': name},
+                   {'$set': {'count': count[name]}}, upsert=True)
+  db.tags.remove({'user': user_id, 'name': {'$nin': names}})
+
+  # Pairs are too many for a $nin; rows not stamped by this run are stale.
+  stamp = ObjectId()
+  tag_pairs = db.tag_pairs.initialize_unordered_bulk_op()
+  for key, value in count.iteritems():
+    if isinstance(key, tuple):
+      tag_pairs.find({'user': user_id, 'tag': key[0], 'other': key[1]}) \
+          .upsert().update_one({'$set': {'count': value, 'reconciled': stamp}})
+  if len(count) > len(names):
+    tag_pairs.execute()
+  db.tag_pairs.remove({'user': user_id, 'reconciled': {'$ne': stamp}})
+
+
+def popular(db, user_id, limit=20):
+  return list(db.tags.find({'user': user_id}, fields=['name', 'count'],
+                           sort=[('count', pymongo.DESCENDING)], limit=limit))
+
+
+def related(db, user_id, tag, limit=20):
+  """Returns the tags most often used together with `tag`, with counts."""
+  return [{'name': pair['other'], 'count': pair['count']}
+          for pair in db.tag_pairs.find({'user': user_id, 'tag': tag},
+                                        fields=['other', 'count'],
+                                        sort=[('count', pymongo.DESCENDING)],
+                                        limit=limit)]
+
+
+def ensure_indexes(db):
+  db.tag_pairs.ensure_index([('user', pymongo.ASCENDING),
+                             ('tag', pymongo.ASCENDING),
+                             ('other', pymongo.ASCENDING)], unique=True)
+  db.tag_pairs.ensure_index([('user', pymongo.ASCENDING),
+                             ('tag', pymongo.ASCENDING),
+                             ('count', pymongo.DESCENDING)])
+
+
+def main():
+  define("config_file", default="app_config.yml", help="app_config file")
+  define("email", default=None, help="reconcile only this user")
+  tornado.options.parse_command_line()
+  config = util.load_config(options.config_file)
+  db = schema.wrap(pymongo.Connection()[config.mongodb_database], config)
+  query = {}
+  if options.email:
+    query['email'] = options.email
+  for user in db.users.find(query, fields=['email']):
+    reconcile(db, user['_id'])
+    logging.info("Reconciled tag and tag pair counts for %s" % user['email'])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,110 @@
+import bisect
+import collections
+import heapq
+import threading
+import time
+
+
+class TagIndex(object):
+  """
+  One user's tag names in sorted order with their counts. Completing a
+  prefix is a bisect and a top-k over the matching range; results for
+  one and two letter prefixes, whose ranges are the longest, are memoized
+  until the next update.
+  """
+  MEMO_PREFIX_LENGTH = 2
+
+  def __init__(self, tags):
+    self.counts = dict((t['name'], t['count']) for t in tags)
+    self.names = sorted(self.counts)
+    self.built = time.time()
+    self.memo = {}
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.names)
+
+  def complete(self, prefix, limit=10):
+    """Returns up to `limit` (name, count) pairs starting with `prefix`,
+    most used first."""
+    with self.lock:
+      memoize = len(prefix) <= self.MEMO_PREFIX_LENGTH
+      if memoize and (prefix, limit) in self.memo:
+        return self.memo[prefix, limit]
+      start = bisect.bisect_left(self.names, prefix)
+      # A scan rather than a bisect for an upper bound: no character sorts
+      # after every continuation on both narrow and wide unicode builds.
+      end = start
+      while end < len(self.names) and self.names[end].startswith(prefix):
+        end += 1
+      names = heapq.nlargest(limit, self.names[start:end],
+                             key=self.counts.__getitem__)
+      result = [(name, self.counts[name]) for name in names]
+      if memoize:
+        self.memo[prefix, limit] = result
+      return result
+
+  def apply(self, delta):
+    """Applies tag count deltas in the format of tagcounts.diff."""
+    with self.lock:
+      self.memo.clear()
+      for name, change in delta.iteritems():
+        if isinstance(name, tuple):
+          continue
+        count = self.counts.get(name, 0) + change
+        if count > 0:
+          if name not in self.counts:
+            bisect.insort(self.names, name)
+          self.counts[name] = count
+        elif name in self.counts:
+          del self.counts[name]
+          del self.names[bisect.bisect_left(self.names, name)]
+
+
+class TagIndexCache(object):
+  """
+  Per-process TagIndex objects, built lazily on a user's first completion.
+  Least recently used indexes are evicted once the indexes hold more than
+  `max_tags` names in total. Mutations made through this process are
+  applied to the index in place; changes made by other processes show up
+  once the index is older than `ttl` seconds and is rebuilt.
+  """
+  def __init__(self, max_tags=500000, ttl=60):
+    self.max_tags = max_tags
+    self.ttl = ttl
+    self.indexes = collections.OrderedDict()
+    self.size = 0
+    self.lock = threading.Lock()
+
+  def get(self, user_id):
+    with self.lock:
+      index = self.indexes.pop(user_id, None)
+      if index is None:
+        return None
+      if index.built + self.ttl < time.time():
+        self.size -= len(index)
+        return None
+      self.indexes[user_id] = index
+      return index
+
+  def put(self, user_id, index):
+    with self.lock:
+      old = self.indexes.pop(user_id, None)
+      if old is not None:
+        self.size -= len(old)
+      self.indexes[user_id] = index
+      self.size += len(index)
+      while self.size > self.max_tags and len(self.indexes) > 1:
+        evicted_id, evicted = self.indexes.popitem(last=False)
+        self.size -= len(evicted)
+    return index
+
+  def apply(self, user_id, delta):
+    """tagcounts listener; may be called from any thread."""
+    with self.lock:
+      index = self.indexes.get(user_id)
+      if index is None:
+        return
+      self.size -= len(index)
+      index.apply(delta)
+      self.size += len(index)
@@ -0,0 +1,99 @@
+import gc
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tornado.util
+
+import importer
+
+HEADER = '''<!DOCTYPE NETSCAPE-Bookmark-file-1>
+<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">
+<TITLE>Bookmarks</TITLE>
+<H1>Bookmarks</H1>
+<DL><p>
+'''
+
+
+class GeneratedFile(object):
+  """A bookmark file of `count` links produced as it is read, so the test
+  itself never holds the whole input."""
+  def __init__(self, count):
+    self.lines = self.generate(count)
+    self.buffer = ''
+
+  def generate(self, count):
+    yield HEADER
+    for i in xrange(count):
+      yield ('<DT><A HREF="http://example.com/%d" ADD_DATE="1300000000" '
+             'TAGS="a,b">Link %d</A>\n<DD>Description %d\n' % (i, i, i))
+    yield '</DL><p>\n'
+
+  def read(self, size):
+    while len(self.buffer) < size:
+      try:
+        self.buffer += next(self.lines)
+      except StopIteration:
+        break
+    data, self.buffer = self.buffer[:size], self.buffer[size:]
+    return data
+
+
+class ParseTest(unittest.TestCase):
+  def importer(self, contents):
+    return importer.Importer(None, tornado.util.ObjectDict(_id=1), contents)
+
+  def parse(self, contents):
+    return list(self.importer(contents).parse(importer.StringIO(contents)))
+
+  def test_fields(self):
+    bookmarks = self.parse(HEADER + '''
+<DT><H3>Folder</H3>
+<DD>Folder description
+<DL><p>
+<DT><A HREF="http://example.com/a" ADD_DATE="1300000000" TAGS="x,y">Tom &amp; Jerry &#233;</A>
+<DD>About &lt;it&gt;
+<DT><A HREF="javascript:void(0)">Skipped</A>
+<DT><A HREF="http://example.com/b"></A>
+</DL><p>
+</DL><p>
+''')
+    self.assertEqual(len(bookmarks), 2)
+    first, second = bookmarks
+    self.assertEqual(first['url'], 'http://example.com/a')
+    self.assertEqual(first['title'], u'Tom & Jerry \xe9')
+    self.assertEqual(first['description'], u'About <it>')
+    self.assertEqual(first['tags'], ['x', 'y'])
+    self.assertEqual(first['modified'].year, 2011)
+    self.assertEqual(second['title'], 'http://example.com/b')
+    self.assertNotIn('description', second)
+
+  def test_chunk_boundaries(self):
+    contents = HEADER + ''.join(
+      '<DT><A HREF="http://example.com/%d">Link \xc3\xa9 %d</A>\n' % (i, i)
+      for i in range(2000))
+    imp = self.importer(contents)
+    imp.CHUNK_SIZE = 7
+    bookmarks = list(imp.parse(importer.StringIO(contents)))
+    self.assertEqual(len(bookmarks), 2000)
+    self.assertEqual(bookmarks[-1]['title'], u'Link \xe9 1999')
+
+  def test_nothing_retained(self):
+    count = 60000
+    imp = self.importer(None)
+    gc.collect()
+    before = len(gc.get_objects())
+    seen = 0
+    for bookmark in imp.parse(GeneratedFile(count)):
+      seen += 1
+      if seen == count // 2:
+        gc.collect()
+        # Half way through, only a chunk's worth of bookmarks may be alive.
+        self.assertLess(len(gc.get_objects()) - before, 20000)
+    self.assertEqual(seen, count)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import tagindex
+
+
+class TagIndexTest(unittest.TestCase):
+  def make_index(self, counts):
+    return tagindex.TagIndex([{'name': name, 'count': count}
+                              for name, count in counts.iteritems()])
+
+  def test_complete(self):
+    index = self.make_index({u'python': 3, u'pyramid': 5, u'perl': 9})
+    self.assertEqual([(u'pyramid', 5), (u'python', 3)], index.complete(u'py'))
+    self.assertEqual([(u'pyramid', 5)], index.complete(u'py', limit=1))
+    self.assertEqual([], index.complete(u'ruby'))
+
+  def test_complete_past_the_bmp(self):
+    index = self.make_index({u'pyth\U0001f600': 2, u'pyth￿': 1, u'pyti': 4})
+    self.assertEqual([(u'pyth\U0001f600', 2), (u'pyth￿', 1)],
+                     index.complete(u'pyth'))
+
+  def test_apply(self):
+    index = self.make_index({u'python': 3})
+    index.complete(u'p')
+    index.apply({u'perl': 1, u'python': -3, (u'perl', u'python'): 1})
+    self.assertEqual([(u'perl', 1)], index.complete(u'p'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import util
+
+
+class CanonicalizeUrlTest(unittest.TestCase):
+  def assertSame(self, *urls):
+    canonical = set(util.canonicalize_url(url) for url in urls)
+    self.assertEqual(1, len(canonical), canonical)
+
+  def test_bad_port(self):
+    self.assertEqual('x.com:abc', util.canonicalize_url('http://x.com:abc/'))
+    self.assertEqual(util.md5('x.com:abc'), util.canonical_digest('http://X.com:abc/'))
+
+  def test_default_ports(self):
+    self.assertSame('http://example.com/a', 'http://example.com:80/a',
+                    'https://example.com:443/a', 'example.com/a')
+    self.assertEqual('example.com:8080/a',
+                     util.canonicalize_url('http://example.com:8080/a'))
+
+  def test_idn_hosts(self):
+    self.assertSame(u'http://bücher.de/', u'http://BÜCHER.de',
+                    'http://xn--bcher-kva.de/')
+
+  def test_fragments(self):
+    self.assertSame('http://example.com/a', 'http://example.com/a#top')
+    self.assertEqual('example.com#!/inbox',
+                     util.canonicalize_url('http://example.com/#!/inbox'))
+
+  def test_query_parameter_order(self):
+    self.assertSame('http://example.com/?b=2&a=1', 'http://example.com/?a=1&b=2',
+                    'http://www.example.com/?a=1&utm_source=x&b=2&gclid=y')
+    self.assertNotEqual(util.canonicalize_url('http://example.com/?a=1'),
+                        util.canonicalize_url('http://example.com/?a=2'))
+
+
+if __name__ == '__main__':
+  unittest.main()
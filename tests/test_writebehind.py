@@ -0,0 +1,106 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pymongo.errors
+from bson import json_util
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase, gen_test
+
+import bulk
+import writebehind
+
+
+class FakeDatabase(object):
+  """Runs jobs inline and records upserts; urls containing 'bad' fail."""
+  db = None
+
+  def __init__(self):
+    self.saved = []
+    self.down = False
+
+  def run(self, fn, *args, **kwargs):
+    future = Future()
+    try:
+      future.set_result(fn(*args, **kwargs))
+    except Exception as e:
+      future.set_exception(e)
+    return future
+
+  def upsert_bookmarks(self, db, user_id, bookmarks):
+    if self.down:
+      raise pymongo.errors.AutoReconnect("down")
+    if any('bad' in b['url'] for b in bookmarks):
+      raise ValueError("bad url")
+    self.saved.extend(b['url'] for b in bookmarks)
+
+
+class WriteBehindBufferTest(AsyncTestCase):
+  def setUp(self):
+    super(WriteBehindBufferTest, self).setUp()
+    self.adb = FakeDatabase()
+    self.upsert_bookmarks = bulk.upsert_bookmarks
+    bulk.upsert_bookmarks = self.adb.upsert_bookmarks
+    self.journal_dir = tempfile.mkdtemp()
+    self.retry_delay = writebehind.WriteBehindBuffer.RETRY_DELAY
+    writebehind.WriteBehindBuffer.RETRY_DELAY = 0.01
+
+  def tearDown(self):
+    bulk.upsert_bookmarks = self.upsert_bookmarks
+    writebehind.WriteBehindBuffer.RETRY_DELAY = self.retry_delay
+    shutil.rmtree(self.journal_dir)
+    super(WriteBehindBufferTest, self).tearDown()
+
+  def make_buffer(self, durability):
+    return writebehind.WriteBehindBuffer(
+      self.adb, self.io_loop, max_delay=0.01, durability=durability,
+      journal_dir=self.journal_dir)
+
+  @gen.coroutine
+  def drain(self, buffer):
+    while len(buffer):
+      yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.01)
+
+  @gen_test
+  def test_failing_save_does_not_block_others(self):
+    buffer = self.make_buffer(writebehind.SYNC)
+    good = buffer.add({'user': 1, 'url': 'http://a.com/'})
+    bad = buffer.add({'user': 1, 'url': 'http://bad.com/'})
+    other = buffer.add({'user': 2, 'url': 'http://b.com/'})
+    yield [good, other]
+    self.assertEqual(['http://a.com/', 'http://b.com/'], sorted(self.adb.saved))
+    with self.assertRaises(ValueError):
+      yield bad
+    yield self.drain(buffer)
+    with open(os.path.join(self.journal_dir, 'rejected')) as f:
+      self.assertIn('http://bad.com/', f.read())
+
+  @gen_test
+  def test_transient_errors_retry_the_batch(self):
+    buffer = self.make_buffer(writebehind.SYNC)
+    self.adb.down = True
+    saved = buffer.add({'user': 1, 'url': 'http://a.com/'})
+    yield gen.Task(self.io_loop.add_timeout, self.io_loop.time() + 0.1)
+    self.assertFalse(saved.done())
+    self.adb.down = False
+    yield saved
+    self.assertEqual(['http://a.com/'], self.adb.saved)
+
+  def test_replay_skips_what_it_cannot_apply(self):
+    path = os.path.join(self.journal_dir, 'writebehind.999999999.current')
+    with open(path, 'w') as f:
+      f.write(json_util.dumps({'user': 1, 'url': 'http://bad.com/'}) + '\n')
+      f.write('{not json\n')
+      f.write(json_util.dumps({'user': 1, 'url': 'http://a.com/'}) + '\n')
+    self.make_buffer(writebehind.JOURNAL)
+    self.assertEqual(['http://a.com/'], self.adb.saved)
+    self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,165 @@
+"""
+Fetch state shared by every bookmark of a page.
+
+The urls collection holds one document per canonical url, with the
+canonical digest as its _id. It keeps what the retriever learned about the
+page: status, errormsg, checked, next_check, etag, last_modified,
+redirects, redirect_digest, snapshot and a text excerpt. Bookmarks only
+reference it through their canonical_digest, and listings join it with
+one $in query per page, so a page is fetched and recorded once however many users
+bookmark it.
+
+The text excerpt is the exception: the bookmark text index cannot join,
+so each bookmark keeps a copy of the first search.MAX_EXCERPT characters,
+rewritten with one multi update only when a fetch extracts a different
+excerpt. The whole text is kept once, with the snapshot.
+
+Bookmarks fetched before the urls collection existed are moved over with
+
+  python dedupe.py --config_file=app_config.yml
+  python urls.py --config_file=app_config.yml
+
+while the retrievers are stopped.
+"""
+import logging
+
+import pymongo
+import tornado.options
+from tornado.options import define, options
+
+import schema
+import search
+import util
+
+# Fetch results, as written by the retriever.
+FIELDS = ('status', 'errormsg', 'checked', 'next_check', 'etag',
+          'last_modified', 'redirects', 'redirect_digest', 'snapshot', 'text')
+# What listings show of a bookmark's page.
+LISTING_FIELDS = ('status', 'snapshot')
+
+
+def ensure_indexes(db):
+  db.urls.ensure_index('next_check')
+  db.urls.ensure_index([('redirect_digest', pymongo.ASCENDING),
+                        ('checked', pymongo.DESCENDING)], sparse=True)
+
+
+def digest(bookmark):
+  return bookmark.get('canonical_digest') or util.canonical_digest(bookmark['url'])
+
+
+def register(db, bookmarks):
+  """
+  Creates url documents for the pages of `bookmarks` that have none yet,
+  with one bulk upsert. Returns the created documents; their pages still
+  have to be fetched.
+  """
+  entries = dict((digest(b), {'_id': digest(b), 'url': b['url']})
+                 for b in bookmarks).values()
+  if not entries:
+    return []
+  bulk = db.urls.initialize_unordered_bulk_op()
+  for entry in entries:
+    bulk.find({'_id': entry['_id']}).upsert() \
+        .update_one({'$setOnInsert': {'url': entry['url']}})
+  result = bulk.execute()
+  return [entries[u['index']] for u in result.get('upserted', [])]
+
+
+def copy_text(db, user_id, bookmarks):
+  """Copies the text excerpt of already fetched pages to new bookmarks,
+  for the search index."""
+  entries = db.urls.find({'_id': {'$in': list(set(digest(b) for b in bookmarks))},
+                          'text': {'$exists': True}}, fields=['text'])
+  bulk = db.bookmarks.initialize_unordered_bulk_op()
+  copied = 0
+  for entry in entries:
+    bulk.find({'user': user_id, 'canonical_digest': entry['_id']}) \
+        .update_one({'$set': {'text': entry['text']}})
+    copied += 1
+  if copied:
+    bulk.execute()
+
+
+def join(db, bookmarks, fields=LISTING_FIELDS):
+  """
+  Returns copies of the bookmark dicts with `fields` of their pages added,
+  reading every page with one query. The originals are left alone, as they
+  may be cached.
+  """
+  if not bookmarks:
+    return []
+  entries = dict((e['_id'], e) for e in db.urls.find(
+    {'_id': {'$in': list(set(digest(b) for b in bookmarks))}}, fields=fields))
+  joined = []
+  for bookmark in bookmarks:
+    entry = entries.get(digest(bookmark), {})
+    joined.append(dict(bookmark, **dict((k, entry[k]) for k in fields if k in entry)))
+  return joined
+
+
+def migrate(db, batch_size=1000):
+  """
+  Moves fetch results stored on bookmarks to the urls collection, keeping
+  the most recent result of each page, and creates url documents for
+  bookmarks never fetched. Page text kept on bookmarks is cut down to its
+  excerpt. Returns the number of bookmarks moved.
+  """
+  moved = 0
+  # Ordered, so a page's document exists before its result is compared.
+  batch = db.urls.initialize_ordered_bulk_op()
+  excerpts = db.bookmarks.initialize_unordered_bulk_op()
+  size = trimmed = 0
+  for bookmark in db.bookmarks.find(
+      {}, fields=('url', 'canonical_digest') + FIELDS,
+      sort=[('_id', pymongo.ASCENDING)]):
+    batch.find({'_id': digest(bookmark)}).upsert() \
+        .update_one({'$setOnInsert': {'url': bookmark['url']}})
+    result = dict((k, bookmark[k]) for k in FIELDS if k in bookmark)
+    if result.get('text'):
+      result['text'] = search.excerpt(result['text'])
+      if result['text'] != bookmark['text']:
+        excerpts.find({'_id': bookmark['_id']}) \
+            .update_one({'$set': {'text': result['text']}})
+        trimmed += 1
+    if result.get('checked'):
+      if result.get('redirects'):
+        redirect_digest = util.canonical_digest(result['redirects'])
+        if redirect_digest != digest(bookmark):
+          result['redirect_digest'] = redirect_digest
+      # Only a later check replaces the result already moved.
+      batch.find({'_id': digest(bookmark),
+                  '$or': [{'checked': {'$exists': False}},
+                          {'checked': {'$lt': result['checked']}}]}) \
+          .update_one({'$set': result})
+      moved += 1
+    size += 1
+    if size == batch_size:
+      batch.execute()
+      if trimmed:
+        excerpts.execute()
+      logging.info("Moved %d fetch results" % moved)
+      batch, size = db.urls.initialize_ordered_bulk_op(), 0
+      excerpts, trimmed = db.bookmarks.initialize_unordered_bulk_op(), 0
+  if size:
+    batch.execute()
+    if trimmed:
+      excerpts.execute()
+  db.bookmarks.update({'checked': {'$exists': True}},
+                      {'$unset': dict((k, 1) for k in FIELDS if k != 'text')},
+                      multi=True)
+  return moved
+
+
+def main():
+  define("config_file", default="app_config.yml", help="app_config file")
+  define("batch_size", default=1000, type=int)
+  tornado.options.parse_command_line()
+  config = util.load_config(options.config_file)
+  db = schema.wrap(pymongo.Connection()[config.mongodb_database], config)
+  ensure_indexes(db)
+  moved = migrate(db, options.batch_size)
+  logging.info("Moved %d fetch results to the urls collection" % moved)
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,112 @@
+import base64
+import calendar
+import datetime
 import hashlib
+import logging
+import urlparse
+import zlib
+
+import tornado.util
+import yaml
 
 def md5(s):
+  if isinstance(s, unicode):
+    s = s.encode('utf8')
   return hashlib.md5(s).hexdigest()
 
+# Retrieval tasks are spread over this many partitions so retriever
+# workers can claim disjoint sets of them.
+NUM_PARTITIONS = 1024
+
+def task_partition(url):
+  """
+  Returns the task partition for `url`. Partitions are picked by host so
+  every request to one host goes through the same retriever worker and
+  its politeness limits.
+  """
+  host = (urlparse.urlsplit(url).hostname or '').lower()
+  return zlib.crc32(host.encode('utf8')) % NUM_PARTITIONS
+
+# Query parameters that only track where a visitor came from.
+TRACKING_PARAMS = frozenset(['gclid', 'fbclid', 'dclid', 'msclkid', 'mc_cid',
+                             'mc_eid', 'yclid', '_hsenc', '_hsmi', 'igshid'])
+
+def canonicalize_url(url):
+  """
+  Returns a canonical form of `url` for detecting duplicates; it is a key,
+  not a url to fetch. The scheme, a leading www., default ports, a trailing
+  slash, the fragment and tracking parameters are dropped, the host is
+  lowercased, internationalized hosts are IDNA encoded and the remaining
+  query parameters are sorted. A url without a scheme is read as http.
+  """
+  url = url.strip()
+  if '://' not in url:
+    url = 'http://' + url
+  parts = urlparse.urlsplit(url)
+  try:
+    port = parts.port
+  except ValueError:
+    # Not a number; keep the netloc as it is.
+    host, port = parts.netloc.lower(), None
+  else:
+    host = (parts.hostname or '').lower().rstrip('.')
+  if isinstance(host, unicode):
+    try:
+      host = host.encode('idna')
+    except UnicodeError:
+      pass
+  if host.startswith('www.'):
+    host = host[4:]
+  if port and port not in (80, 443):
+    host += ':%d' % port
+  path = parts.path.rstrip('/')
+  query = sorted(param for param in parts.query.split('&') if param and
+                 not param.startswith('utm_') and
+                 param.partition('=')[0].lower() not in TRACKING_PARAMS)
+  canonical = host + path
+  if query:
+    canonical += '?' + '&'.join(query)
+  # Hash-bang fragments address content in single page apps.
+  if parts.fragment.startswith('!'):
+    canonical += '#' + parts.fragment
+  return canonical
+
+def canonical_digest(url):
+  return md5(canonicalize_url(url))
+
+def encode_cursor(modified, id):
+  """
+  Returns an opaque continuation token for a (modified, _id) sort position.
+  Bookmarks without a modified date sort last and are encoded as '-'.
+  """
+  if modified is None:
+    stamp = '-'
+  else:
+    stamp = '%d' % (calendar.timegm(modified.utctimetuple()) * 1000 +
+                    modified.microsecond // 1000)
+  return base64.urlsafe_b64encode('%s:%s' % (stamp, id))
+
+def decode_cursor(token):
+  """
+  Returns (modified, id) for a token created by encode_cursor. Raises
+  ValueError if the token is malformed.
+  """
+  try:
+    stamp, id = base64.urlsafe_b64decode(str(token)).split(':', 1)
+  except (TypeError, ValueError):
+    raise ValueError("Invalid cursor %r" % token)
+  if stamp == '-':
+    return None, id
+  stamp = int(stamp)
+  modified = (datetime.datetime.utcfromtimestamp(stamp // 1000) +
+              datetime.timedelta(milliseconds=stamp % 1000))
+  return modified, id
+
+def load_config(path):
+  logging.debug("Loading app config")
+  stream = file(path, 'r')
+  return tornado.util.ObjectDict(yaml.load(stream))
+
 # Copied from django with some modifications
 import copy
 
@@ -0,0 +1,303 @@
+import collections
+import errno
+import glob
+import logging
+import os
+import time
+
+import pymongo.errors
+from bson import json_util
+from tornado.concurrent import Future
+
+import bulk
+
+MEMORY = 'memory'
+JOURNAL = 'journal'
+SYNC = 'sync'
+
+# Errors after which a whole batch is written again, however often they
+# happen. Any other error only fails the saves it is raised for.
+TRANSIENT_ERRORS = (pymongo.errors.ConnectionFailure,)
+
+
+class WriteBehindBuffer(object):
+  """
+  Buffers bookmark saves and writes them with bulk.upsert_bookmarks, one
+  bulk write per user, once `max_size` saves are pending or `max_delay`
+  seconds after the first one. Retrieval tasks for new bookmarks are queued
+  by the same flush.
+
+  `add` returns a Future that resolves when the save is acknowledged:
+    memory   as soon as it is buffered; a crash loses pending saves
+    journal  once it is appended and fsynced to a journal file in
+             `journal_dir`; journals left behind by a crash are replayed
+             on startup by the next buffer using the same directory.
+             Saves arriving while an fsync runs are appended and fsynced
+             together by the next one, on the executor.
+    sync     once the batch containing it has been written to Mongo
+
+  `on_flush` is called on the IOLoop with the ids of the users whose
+  bookmarks were written.
+
+  A save that fails `MAX_ATTEMPTS` flushes for another reason than a lost
+  connection is logged, appended to `journal_dir`/rejected if there is a
+  journal, and dropped; in sync mode its Future gets the error.
+  """
+  RETRY_DELAY = 5
+  MAX_ATTEMPTS = 3
+
+  def __init__(self, adb, io_loop, max_size=100, max_delay=1.0,
+               durability=JOURNAL, journal_dir=None, on_flush=None):
+    if durability not in (MEMORY, JOURNAL, SYNC):
+      raise ValueError("Unknown durability %r" % durability)
+    if durability == JOURNAL and not journal_dir:
+      raise ValueError("journal durability needs a journal_dir")
+    self.adb = adb
+    self.io_loop = io_loop
+    self.max_size = max_size
+    self.max_delay = max_delay
+    self.durability = durability
+    self.journal_dir = journal_dir
+    self.on_flush = on_flush
+    self.pending = []
+    # Futures of sync saves, and failed attempts of saves, by id(bookmark).
+    self.waiters = {}
+    self.attempts = {}
+    # Saves waiting for the journal, and whether it is being synced.
+    self.unsynced = []
+    self.syncing = False
+    self.flush_deferred = False
+    self.flushing = False
+    self.timeout = None
+    self.journal = None
+    if durability == JOURNAL:
+      if not os.path.isdir(journal_dir):
+        os.makedirs(journal_dir)
+      self.replay()
+      self.open_journal()
+      self.schedule_flush()
+
+  def __len__(self):
+    return (len(self.pending) + len(self.unsynced) +
+            (1 if self.flushing or self.syncing else 0))
+
+  def add(self, bookmark):
+    future = Future()
+    if self.journal is not None:
+      self.unsynced.append((bookmark, future))
+      if not self.syncing:
+        self.sync_journal()
+      return future
+    self.pending.append(bookmark)
+    if self.durability == SYNC:
+      self.waiters[id(bookmark)] = future
+    else:
+      future.set_result(None)
+    self.schedule_flush()
+    return future
+
+  def schedule_flush(self):
+    if len(self.pending) >= self.max_size:
+      self.flush()
+    elif self.pending and self.timeout is None and not self.flushing:
+      self.timeout = self.io_loop.add_timeout(time.time() + self.max_delay,
+                                              self.flush)
+
+  def sync_journal(self):
+    """Appends and fsyncs every unsynced save with one fsync."""
+    self.syncing = True
+    saves, self.unsynced = self.unsynced, []
+    self.io_loop.add_future(
+      self.adb.run(self.append_journal, self.journal,
+                   [json_util.dumps(bookmark) + '\n' for bookmark, _ in saves]),
+      lambda future: self.on_synced(future, saves))
+
+  def append_journal(self, journal, lines):
+    """Runs on the executor."""
+    journal.writelines(lines)
+    journal.flush()
+    os.fsync(journal.fileno())
+
+  def on_synced(self, future, saves):
+    self.syncing = False
+    try:
+      future.result()
+    except Exception as e:
+      logging.exception("Journaling %d saves failed" % len(saves))
+      for _, waiter in saves:
+        waiter.set_exception(e)
+    else:
+      for bookmark, waiter in saves:
+        self.pending.append(bookmark)
+        waiter.set_result(None)
+    if self.flush_deferred:
+      self.flush_deferred = False
+      self.flush()
+    else:
+      self.schedule_flush()
+    if self.unsynced:
+      self.sync_journal()
+
+  def flush(self):
+    if self.timeout is not None:
+      self.io_loop.remove_timeout(self.timeout)
+      self.timeout = None
+    if self.syncing:
+      # The journal can't be rotated under the executor; flush once the
+      # sync is done.
+      self.flush_deferred = True
+      return
+    if self.flushing or not self.pending:
+      return
+    self.flushing = True
+    batch, self.pending = self.pending, []
+    journal = self.rotate_journal()
+    self.io_loop.add_future(
+      self.adb.run(self.write, batch),
+      lambda future: self.on_written(future, batch, journal))
+
+  def write(self, batch):
+    """
+    Runs on the executor. Returns the ids of the users whose bookmarks were
+    written and the saves that failed. Transient errors are raised.
+    """
+    by_user = collections.defaultdict(list)
+    for bookmark in batch:
+      by_user[bookmark['user']].append(bookmark)
+    user_ids, failed = [], []
+    for user_id, bookmarks in by_user.iteritems():
+      try:
+        bulk.upsert_bookmarks(self.adb.db, user_id, bookmarks)
+      except TRANSIENT_ERRORS:
+        raise
+      except Exception:
+        logging.exception("Saving %d bookmarks for %s failed, saving them one "
+                          "at a time" % (len(bookmarks), user_id))
+        for bookmark in bookmarks:
+          try:
+            bulk.upsert_bookmarks(self.adb.db, user_id, [bookmark])
+          except TRANSIENT_ERRORS:
+            raise
+          except Exception:
+            logging.exception("Saving %s for %s failed" % (
+              bookmark.get('url'), user_id))
+            failed.append(bookmark)
+      user_ids.append(user_id)
+    return user_ids, failed
+
+  def on_written(self, future, batch, journal):
+    self.flushing = False
+    try:
+      user_ids, failed = future.result()
+    except Exception:
+      logging.exception("Write-behind flush of %d saves failed" % len(batch))
+      # Keep the saves, and their journal, for the next attempt.
+      self.retry(batch, journal)
+      return
+
+    retried = []
+    for bookmark in failed:
+      attempts = self.attempts.get(id(bookmark), 0) + 1
+      if attempts < self.MAX_ATTEMPTS:
+        self.attempts[id(bookmark)] = attempts
+        retried.append(bookmark)
+      else:
+        self.reject(bookmark)
+    failed = set(id(b) for b in failed)
+    for bookmark in batch:
+      if id(bookmark) not in failed:
+        self.attempts.pop(id(bookmark), None)
+        waiter = self.waiters.pop(id(bookmark), None)
+        if waiter is not None:
+          waiter.set_result(None)
+    if self.on_flush is not None:
+      self.on_flush(user_ids)
+    if retried:
+      # The journal still holds the saves to retry.
+      self.retry(retried, journal)
+      return
+    if journal is not None:
+      os.remove(journal)
+      for path in glob.glob(self.journal_path('*.retry')):
+        os.remove(path)
+    self.schedule_flush()
+
+  def retry(self, saves, journal):
+    self.pending[:0] = saves
+    if journal is not None:
+      os.rename(journal, journal + '.retry')
+    if self.timeout is None:
+      self.timeout = self.io_loop.add_timeout(time.time() + self.RETRY_DELAY,
+                                              self.flush)
+
+  def reject(self, bookmark):
+    """Gives up on a save that keeps failing."""
+    self.attempts.pop(id(bookmark), None)
+    line = json_util.dumps(bookmark)
+    logging.error("Dropping a save that keeps failing: %s" % line)
+    if self.journal_dir:
+      with open(os.path.join(self.journal_dir, 'rejected'), 'a') as f:
+        f.write(line + '\n')
+    waiter = self.waiters.pop(id(bookmark), None)
+    if waiter is not None:
+      waiter.set_exception(ValueError("Save of %s failed" % bookmark.get('url')))
+
+  def journal_path(self, suffix):
+    return os.path.join(self.journal_dir,
+                        'writebehind.%d.%s' % (os.getpid(), suffix))
+
+  def open_journal(self):
+    self.journal = open(self.journal_path('current'), 'a')
+
+  def rotate_journal(self):
+    """Moves the journal of the batch being flushed aside. Returns its path."""
+    if self.journal is None:
+      return None
+    self.journal.close()
+    path = self.journal_path('%f.flushing' % time.time())
+    os.rename(self.journal_path('current'), path)
+    self.open_journal()
+    return path
+
+  def replay(self):
+    """Writes saves from journals that a crashed process left behind."""
+    for path in glob.glob(os.path.join(self.journal_dir, 'writebehind.*')):
+      pid = int(os.path.basename(path).split('.')[1])
+      if pid == os.getpid() or process_alive(pid):
+        continue
+      claimed = self.journal_path('%f.replay' % time.time())
+      try:
+        os.rename(path, claimed)
+      except OSError:
+        # Another process claimed it first.
+        continue
+      batch = []
+      with open(claimed) as f:
+        for line in f:
+          if not line.strip():
+            continue
+          try:
+            batch.append(json_util.loads(line))
+          except ValueError:
+            logging.error("Skipping an unreadable save in %s: %r" % (path, line))
+      logging.info("Replaying %d saves from %s" % (len(batch), path))
+      try:
+        user_ids, failed = self.write(batch)
+      except TRANSIENT_ERRORS:
+        logging.exception("Replaying %s failed, retrying it with the next "
+                          "flush" % path)
+        # Cleaned up by the first flush that writes everything.
+        os.rename(claimed, self.journal_path('%f.retry' % time.time()))
+        self.pending.extend(batch)
+        continue
+      for bookmark in failed:
+        self.reject(bookmark)
+      os.remove(claimed)
+
+
+def process_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.EPERM
+  return True